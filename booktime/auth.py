@@ -1,25 +1,154 @@
 from urllib.parse import parse_qs
 from channels.auth import AuthMiddlewareStack
+from channels.db import database_sync_to_async
+from channels.middleware import BaseMiddleware
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
 from rest_framework.authtoken.models import Token
 
 
-class TokenGetAuthMiddleware:
-    def __init__(self, inner):
-        self.inner = inner
+# Backends whose entries other processes cannot see or drop
+LOCAL_CACHES = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+def token_cache_key(key):
+    return 'auth-token:%s' % key
+
+
+def token_cache():
+    """
+    Returns the cache of token users, or None when TOKEN_CACHE is not a
+    cache shared by every process, which invalidation could not reach.
+    """
+    alias = getattr(settings, 'TOKEN_CACHE', None)
+    if alias not in settings.CACHES:
+        return None
+    if settings.CACHES[alias]['BACKEND'] in LOCAL_CACHES:
+        return None
+    return caches[alias]
+
+
+# What is cached of a token and its user; never the password hash
+TOKEN_FIELDS = ('key', 'user_id', 'created')
+USER_FIELDS = (
+    'id',
+    'email',
+    'first_name',
+    'last_name',
+    'is_active',
+    'is_staff',
+    'is_superuser',
+    'last_login',
+    'date_joined',
+)
+
+
+def field_values(instance, fields):
+    return {field: getattr(instance, field) for field in fields}
+
+
+def from_field_values(model, values):
+    """ Rebuilds a saved instance of model from a dict of field values """
+    # from_db() expects the values in the order of the model's fields
+    names = [
+        field.attname
+        for field in model._meta.concrete_fields
+        if field.attname in values
+    ]
+    return model.from_db(
+        model.objects.db, names, [values[name] for name in names]
+    )
+
+
+def load_token(key):
+    """
+    Returns the token of key with its user, or None.
 
-    def __call__(self, scope):
+    Tokens are cached for TOKEN_CACHE_TIMEOUT seconds, as the fields
+    of TOKEN_FIELDS and USER_FIELDS from which both are rebuilt; the
+    entries are dropped when the token is deleted or the user saved or
+    updated.
+    """
+    cache = token_cache()
+    cache_key = token_cache_key(key)
+    entry = cache.get(cache_key) if cache is not None else None
+    if entry is not None:
+        token_values, user_values = entry
+        token = from_field_values(Token, token_values)
+        token.user = from_field_values(get_user_model(), user_values)
+        return token
+
+    try:
+        token = Token.objects.select_related('user').get(key=key)
+    except Token.DoesNotExist:
+        return None
+    if cache is not None:
+        cache.set(
+            cache_key,
+            (
+                field_values(token, TOKEN_FIELDS),
+                field_values(token.user, USER_FIELDS),
+            ),
+            getattr(settings, 'TOKEN_CACHE_TIMEOUT', 300),
+        )
+    return token
+
+
+def token_user(key):
+    """ Returns the active user of a token, or None """
+    token = load_token(key)
+    if token is None or not token.user.is_active:
+        return None
+    return token.user
+
+
+def forget_tokens(*keys):
+    cache = token_cache()
+    if cache is not None and keys:
+        cache.delete_many([token_cache_key(key) for key in keys])
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """ DRF token authentication going through the token cache """
+
+    def authenticate_credentials(self, key):
+        token = load_token(key)
+        if token is None:
+            raise exceptions.AuthenticationFailed('Invalid token.')
+        if not token.user.is_active:
+            raise exceptions.AuthenticationFailed(
+                'User inactive or deleted.'
+            )
+        return token.user, token
+
+
+class TokenGetAuthMiddleware(BaseMiddleware):
+    """
+    Authenticates the user of the ?token= query parameter.
+
+    It runs inside AuthMiddlewareStack and replaces the session user
+    once the token is resolved, so the lookup does not block the loop.
+    """
+
+    def populate_scope(self, scope):
+        pass
+
+    async def resolve_scope(self, scope):
         params = parse_qs(scope['query_string'])
         if b'token' in params:
-            try:
-                token_key = params[b'token'][0].decode()
-                token = Token.objects.get(key=token_key)
-                scope['user'] = token.user
-            except Token.DoesNotExist:
-                pass
-
-        return self.inner(scope)
+            user = await database_sync_to_async(token_user)(
+                params[b'token'][0].decode()
+            )
+            if user is not None:
+                scope['user']._wrapped = user
 
 
-TokenGetAuthMiddlewareStack = lambda inner: TokenGetAuthMiddleware(
-    AuthMiddlewareStack(inner)
+TokenGetAuthMiddlewareStack = lambda inner: AuthMiddlewareStack(
+    TokenGetAuthMiddleware(inner)
 )
@@ -1,6 +1,7 @@
 from channels.routing import ProtocolTypeRouter, URLRouter
 from .auth import TokenGetAuthMiddlewareStack
 import main.routing
+from main.lifespan import Lifespan
 from django.urls import re_path
 from channels.http import AsgiHandler
 
@@ -12,6 +13,7 @@ application = ProtocolTypeRouter(
         'http': URLRouter(
             main.routing.http_urlpatterns
             + [re_path(r'', AsgiHandler)]
-        )
+        ),
+        'lifespan': Lifespan,
     }
 )
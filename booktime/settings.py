@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/2.2/ref/settings/
 """
 
 import os
+import sys
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -49,6 +50,8 @@ INSTALLED_APPS = [
 ]
 
 # Django Channels
+# Resources are released on ASGI lifespan shutdown, which uvicorn and
+# hypercorn send but Daphne does not, see main.lifespan
 ASGI_APPLICATION = 'booktime.routing.application'
 
 CHANNEL_LAYERS = {
@@ -60,12 +63,88 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Redis pool shared by the consumers of a worker process
+REDIS_URL = 'redis://localhost'
+REDIS_POOL_MINSIZE = 1
+REDIS_POOL_MAXSIZE = 20
+
+# Carrier tracking lookups; the URL may contain an {order_id} placeholder
+ORDER_TRACKER_URL = 'https://pastebin.com/raw/b2Niddnk'
+ORDER_TRACKER_TIMEOUT = 5
+ORDER_TRACKER_CONNECTIONS = 20
+ORDER_TRACKER_CACHE_TTL = 60
+# Consecutive failures opening the circuit, and seconds before a retry
+ORDER_TRACKER_FAILURE_THRESHOLD = 5
+ORDER_TRACKER_RESET_TIMEOUT = 30
+# Seconds to wait for a refresh before serving a stale payload
+ORDER_TRACKER_STALE_TIMEOUT = 1
+# Most orders per batch tracking request, and lookups run at once
+ORDER_TRACKER_BATCH_SIZE = 100
+ORDER_TRACKER_BATCH_CONCURRENCY = 8
+
+# Seconds during which chat heartbeats are batched before being written
+PRESENCE_FLUSH_INTERVAL = 0.5
+
+
+# Async code logs through a queue, the file is written by a thread
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'verbose': {
+            'format': '%(asctime)s %(levelname)s %(name)s %(message)s',
+        },
+    },
+    'handlers': {
+        'consumers': {
+            'class': 'main.log.QueueFileHandler',
+            'filename': os.path.join(BASE_DIR, 'consumers.log'),
+            'formatter': 'verbose',
+        },
+    },
+    'loggers': {
+        name: {
+            'handlers': ['consumers'],
+            'level': 'DEBUG' if DEBUG else 'INFO',
+        }
+        for name in (
+            'main.consumers',
+            'main.chat_history',
+            'main.presence',
+            'main.redis_pool',
+            'main.tracking',
+        )
+    },
+}
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # Shared by every process, so that invalidation reaches them all
+    'tokens': {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': REDIS_URL + '/1',
+        'KEY_PREFIX': 'booktime',
+    },
+}
+
+# The test runner needs no Redis; token lookups are not cached then
+if sys.argv[1:2] == ['test']:
+    CACHES['tokens'] = {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+
+# Cache of token -> user lookups, and seconds they are kept. Lookups
+# are not cached when the cache is local to a process.
+TOKEN_CACHE = 'tokens'
+TOKEN_CACHE_TIMEOUT = 300
 
 # For Django Rest Framework
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES':
         ('rest_framework.authentication.SessionAuthentication',
-         'rest_framework.authentication.TokenAuthentication',
+         'booktime.auth.CachedTokenAuthentication',
          'rest_framework.authentication.BasicAuthentication'),
 
     'DEFAULT_PERMISSION_CLASSES':
@@ -175,6 +254,32 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
 MEDIA_URL = '/media/'
 
+# For invoice PDF rendering. Invoices hold customer addresses, so the
+# cache is kept out of MEDIA_ROOT and only served by the admin views.
+INVOICE_CACHE_DIR = os.path.join(BASE_DIR, 'var', 'invoices')
+INVOICE_RENDER_WORKERS = 2
+INVOICE_RENDER_QUEUE_SIZE = 8
+INVOICE_RENDER_TIMEOUT = 10
+# Processes rendering invoice batches (None: one per CPU), and the
+# number of orders above which merged PDFs are built in the background
+INVOICE_BATCH_PROCESSES = None
+INVOICE_MERGE_SYNC_LIMIT = 20
+# Threads running background merges, seconds after which a merge that
+# stopped writing is given up, and seconds merged PDFs are kept
+INVOICE_MERGE_WORKERS = 1
+INVOICE_MERGE_TIMEOUT = 600
+INVOICE_MERGE_MAX_AGE = 86400
+
+# Customer service chat history
+CHAT_HISTORY_KEY_PREFIX = 'customer-service:chat:'
+CHAT_HISTORY_STREAM_LENGTH = 500
+# Streams expire this many seconds after their last message
+CHAT_HISTORY_STREAM_TTL = 86400
+CHAT_HISTORY_REPLAY = 50
+CHAT_HISTORY_PAGE_SIZE = 50
+CHAT_HISTORY_FLUSH_INTERVAL = 2
+CHAT_MESSAGE_MAX_LENGTH = 2000
+
 
 if not DEBUG:
     EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
@@ -2,19 +2,38 @@ from django.contrib import admin
 from django.utils.html import format_html
 from django.contrib.auth.admin import UserAdmin as DjangoUserAdmin
 from datetime import datetime, timedelta
+import itertools
 import logging
-from django.db.models.functions import TruncDay
 from django.db.models import Avg, Count, Min, Sum
 from django.urls import path
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
 from django.template.response import TemplateResponse
 from django import forms
-from django.shortcuts import get_object_or_404, render
-from django.http import HttpResponse
+from django.contrib import messages
+from django.shortcuts import get_object_or_404, redirect, render
 from django.template.loader import render_to_string
-from weasyprint import HTML
+from django.conf import settings
+from django.http import (
+    FileResponse,
+    Http404,
+    HttpResponse,
+    HttpResponseBadRequest,
+    StreamingHttpResponse,
+)
+import os
 import tempfile
 
-from . import models
+from . import (
+    chat_history,
+    dispatch,
+    exceptions,
+    exports,
+    invoices,
+    models,
+    paginators,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -35,6 +54,131 @@ make_inactive.short_description = (
 )
 
 
+def download_invoices(self, request, queryset):
+    response = StreamingHttpResponse(
+        invoices.zip_chunks(invoices.render_batch(queryset)),
+        content_type='application/zip',
+    )
+    response['Content-Disposition'] = (
+        'attachment; filename="invoices.zip"'
+    )
+    return response
+
+
+download_invoices.short_description = (
+    'Download invoices of selected orders (ZIP)'
+)
+
+
+def download_merged_invoice(self, request, queryset):
+    # Large merges go to the worker pool instead of tying up the request
+    if queryset.count() > getattr(settings, 'INVOICE_MERGE_SYNC_LIMIT', 20):
+        try:
+            key = invoices.submit_merged(queryset)
+        except exceptions.InvoiceRenderBusy:
+            self.message_user(
+                request,
+                'Too many invoices are being generated, '
+                'please retry shortly.',
+                messages.WARNING,
+            )
+            return None
+        return redirect(
+            '%s:merged_invoice' % self.admin_site.name, key=key
+        )
+
+    fd, path = tempfile.mkstemp(suffix='.pdf')
+    with os.fdopen(fd, 'wb') as f:
+        invoices.write_merged_pdf(queryset, f)
+    response = StreamingHttpResponse(
+        invoices.file_chunks(path, delete=True),
+        content_type='application/pdf',
+    )
+    response['Content-Disposition'] = (
+        'attachment; filename="invoices.pdf"'
+    )
+    return response
+
+
+download_merged_invoice.short_description = (
+    'Download invoices of selected orders (single PDF)'
+)
+
+
+def mark_lines_processing(self, request, queryset):
+    updated = models.Order.objects.dispatch_lines(
+        queryset, models.OrderLine.PROCESSING
+    )
+    self.message_user(request, '%d lines marked as processing' % updated)
+
+
+mark_lines_processing.short_description = (
+    'Mark all lines of selected orders as processing'
+)
+
+
+def mark_lines_sent(self, request, queryset):
+    updated = models.Order.objects.dispatch_lines(
+        queryset, models.OrderLine.SENT
+    )
+    self.message_user(request, '%d lines marked as sent' % updated)
+
+
+mark_lines_sent.short_description = (
+    'Mark all lines of selected orders as sent'
+)
+
+
+class ApproximateCountPaginator(Paginator):
+    """
+    Paginator trusting PostgreSQL's planner statistics for big tables.
+
+    Unfiltered querysets get their count from pg_class.reltuples when
+    the estimate is above threshold; small, fresh (never analyzed) or
+    filtered sets and other databases are counted exactly.
+    """
+    threshold = 100000
+
+    @cached_property
+    def count(self):
+        count = self.estimated_count()
+        if count is None:
+            return super().count
+        return count
+
+    def estimated_count(self):
+        """
+        Returns the estimate, or the exact count below threshold, in a
+        single query; None when the queryset has to be counted by Django.
+        """
+        query = getattr(self.object_list, 'query', None)
+        if (
+            query is None
+            or query.where
+            or query.distinct
+            or query.combinator
+        ):
+            return None
+
+        connection = connections[self.object_list.db]
+        if connection.vendor != 'postgresql':
+            return None
+
+        table = self.object_list.model._meta.db_table
+        with connection.cursor() as cursor:
+            # The COUNT(*) subplan only runs when the estimate is too low
+            cursor.execute(
+                'SELECT CASE WHEN reltuples >= %%s '
+                'THEN reltuples::bigint '
+                'ELSE (SELECT COUNT(*) FROM %s) END '
+                'FROM pg_class WHERE oid = %%s::regclass'
+                % connection.ops.quote_name(table),
+                [self.threshold, table],
+            )
+            row = cursor.fetchone()
+        return row[0] if row else None
+
+
 class ProductAdmin(admin.ModelAdmin):
     list_display = ('name', 'slug', 'is_stock', 'price')
     list_filter = ('active', 'is_stock', 'date_updated')
@@ -82,6 +226,7 @@ class ProductTagAdmin(admin.ModelAdmin):
 
 class ProductImageAdmin(admin.ModelAdmin):
     list_display = ('thumbnail_tag', 'product_name')
+    list_select_related = ('product',)
     readonly_fields = ('thumbnail',)
     search_fields = ('product__name',)
 
@@ -97,6 +242,8 @@ class ProductImageAdmin(admin.ModelAdmin):
     def product_name(self, obj):
         return obj.product.name
 
+    product_name.admin_order_field = 'product__name'
+
 
 class UserAdmin(DjangoUserAdmin):
     fieldsets = (
@@ -137,6 +284,7 @@ class UserAdmin(DjangoUserAdmin):
         "last_name",
         "is_staff",
     )
+    # Backed by the trigram indexes of migration 0008 on PostgreSQL
     search_fields = ("email", "first_name", "last_name")
     ordering = ("email",)
 
@@ -150,6 +298,7 @@ class AddressAdmin(admin.ModelAdmin):
         'city',
         'country',
     )
+    list_select_related = ('user',)
     readonly_fields = ('user',)
 
 
@@ -160,10 +309,22 @@ class BasketlineInline(admin.TabularInline):
 
 class BasketAdmin(admin.ModelAdmin):
     list_display = ('id', 'user', 'status', 'count')
+    list_select_related = ('user',)
     list_editable = ('status',)
     list_filter = ('status',)
+    paginator = ApproximateCountPaginator
+    show_full_result_count = False
     inlines = (BasketlineInline,)
 
+    def get_queryset(self, request):
+        qs = super().get_queryset(request)
+        return qs.annotate(item_count=Sum('basketline__quantity'))
+
+    def count(self, obj):
+        return obj.item_count or 0
+
+    count.admin_order_field = 'item_count'
+
 
 class OrderLineInline(admin.TabularInline):
     model = models.OrderLine
@@ -172,9 +333,13 @@ class OrderLineInline(admin.TabularInline):
 
 class OrderAdmin(admin.ModelAdmin):
     list_display = ('id', 'user', 'status')
+    list_select_related = ('user',)
     list_editable = ('status',)
     list_filter = ('status', 'shipping_country', 'date_added')
+    paginator = ApproximateCountPaginator
+    show_full_result_count = False
     inlines = (OrderLineInline,)
+    actions = [download_invoices, download_merged_invoice]
     fieldsets = (
         (None, {'fields': ('user', 'status')}),
         (
@@ -213,10 +378,14 @@ class CentralOfficeOrderLineInLine(admin.TabularInline):
 
 class CentralOfficeOrderAdmin(admin.ModelAdmin):
     list_display = ('id', 'user', 'status')
+    list_select_related = ('user',)
     list_editable = ('status',)
     readonly_fields = ('user',)
     list_filter = ('status', 'shipping_country', 'date_added')
+    paginator = ApproximateCountPaginator
+    show_full_result_count = False
     inlines = (CentralOfficeOrderLineInLine,)
+    actions = [download_invoices, download_merged_invoice]
     fieldsets = (
         (None, {'fields': ('user', 'status')}),
         (
@@ -249,15 +418,46 @@ class CentralOfficeOrderAdmin(admin.ModelAdmin):
     )
 
 
+class DispatchWaveFilter(admin.SimpleListFilter):
+    """
+    Filters orders on whether they are in a wave, without listing the
+    waves, which would take a query and grow with every planning run.
+    A single wave is shown with ?dispatch_wave__id__exact=, as linked
+    from the dispatch waves page.
+    """
+    title = 'dispatch wave'
+    parameter_name = 'planned'
+
+    def lookups(self, request, model_admin):
+        return (('no', 'Not in a wave'), ('yes', 'In a wave'))
+
+    def queryset(self, request, queryset):
+        if self.value() in ('no', 'yes'):
+            return queryset.filter(
+                dispatch_wave__isnull=self.value() == 'no'
+            )
+        return queryset
+
+
 class DispatchersOrderAdmin(admin.ModelAdmin):
     list_display = (
         'id',
         'shipping_name',
         'date_added',
         'status',
+        'dispatch_wave',
     )
-    list_filter = ('status', 'shipping_country', 'date_added')
+    list_select_related = ('dispatch_wave',)
+    list_filter = (
+        'status',
+        DispatchWaveFilter,
+        'shipping_country',
+        'date_added',
+    )
+    paginator = ApproximateCountPaginator
+    show_full_result_count = False
     inlines = (CentralOfficeOrderLineInLine,)
+    actions = [mark_lines_processing, mark_lines_sent]
     fieldsets = (
         (None, {'fields': ('user', 'status')}),
         (
@@ -296,7 +496,24 @@ class PeriodSelectForm(forms.Form):
     )
 
 
+class WavePlanForm(forms.Form):
+    capacity = forms.IntegerField(
+        min_value=1, initial=dispatch.WAVE_CAPACITY
+    )
+    prefix_length = forms.IntegerField(
+        min_value=1, max_value=12, initial=dispatch.ZIP_PREFIX_LENGTH
+    )
+
+
+class ChatSearchForm(forms.Form):
+    q = forms.CharField(
+        label='Keywords, order ID or customer email', max_length=200
+    )
+
+
 class ReportingColoredAdminSite(ColoredAdminSite):
+    extra_reporting_pages = ()
+
     def get_urls(self):
         urls = super().get_urls()
         my_urls = [
@@ -309,21 +526,44 @@ class ReportingColoredAdminSite(ColoredAdminSite):
                 self.admin_view(self.most_bought_products),
                 name='most_bought_products',
             ),
+            path(
+                'orders_per_day/export/',
+                self.admin_view(self.export_orders_per_day),
+                name='orders_per_day_export',
+            ),
+            path(
+                'most_bought_products/export/',
+                self.admin_view(self.export_most_bought_products),
+                name='most_bought_products_export',
+            ),
         ]
         return my_urls + urls
 
-    def orders_per_day(self, request):
+    def orders_per_day_data(self):
         starting_day = datetime.now() - timedelta(days=180)
-        order_data = (
-            models.Order.objects.filter(
-                date_added__gt=starting_day
-            )
-                .annotate(
-                day=TruncDay('date_added')
+        return (
+            models.DailySales.objects.filter(
+                day__gte=starting_day.date(), product__isnull=True
             )
                 .values('day')
-                .annotate(c=Count('id'))
+                .annotate(c=Sum('orders'))
+                .order_by('day')
         )
+
+    def most_bought_products_data(self, days):
+        starting_day = datetime.now() - timedelta(days=days)
+        return (
+            models.DailySales.objects.filter(
+                day__gte=starting_day.date(),
+                product__isnull=False,
+            )
+                .values('product__name')
+                .annotate(c=Sum('units'))
+                .order_by('-c')
+        )
+
+    def orders_per_day(self, request):
+        order_data = self.orders_per_day_data()
         labels = [
             x['day'].strftime('%Y-%m-%d') for x in order_data
         ]
@@ -345,16 +585,7 @@ class ReportingColoredAdminSite(ColoredAdminSite):
             form = PeriodSelectForm(request.POST)
             if form.is_valid():
                 days = form.cleaned_data['period']
-                starting_day = datetime.now() - timedelta(
-                    days=days
-                )
-                data = (
-                    models.OrderLine.objects.filter(
-                        order__date_added__gt=starting_day
-                    )
-                        .values('product__name')
-                        .annotate(c=Count('id'))
-                )
+                data = self.most_bought_products_data(days)
                 logger.info(
                     'most_bought_products query: %s', data.query
                 )
@@ -377,6 +608,30 @@ class ReportingColoredAdminSite(ColoredAdminSite):
             request, 'most_bought_products.html', context
         )
 
+    def export_orders_per_day(self, request):
+        return exports.export_response(
+            self.orders_per_day_data().iterator(
+                chunk_size=exports.CHUNK_SIZE
+            ),
+            ('day', 'c'),
+            'orders_per_day',
+            request.GET.get('format', 'csv'),
+        )
+
+    def export_most_bought_products(self, request):
+        form = PeriodSelectForm(request.GET)
+        if not form.is_valid():
+            return HttpResponseBadRequest('Invalid period')
+
+        return exports.export_response(
+            self.most_bought_products_data(
+                form.cleaned_data['period']
+            ).iterator(chunk_size=exports.CHUNK_SIZE),
+            ('product__name', 'c'),
+            'most_bought_products',
+            request.GET.get('format', 'csv'),
+        )
+
     def index(self, request, extra_context=None):
         reporting_pages = [
             {
@@ -388,6 +643,7 @@ class ReportingColoredAdminSite(ColoredAdminSite):
                 'link': 'most_bought_products/',
             },
         ]
+        reporting_pages.extend(self.extra_reporting_pages)
         if not extra_context:
             extra_context = {}
         extra_context = {'reporting_pages': reporting_pages}
@@ -402,30 +658,65 @@ class InvoiceMixin:
                 'invoice/<int:order_id>/',
                 self.admin_view(self.invoice_for_order),
                 name='invoice',
-            )
+            ),
+            path(
+                'invoices/merged/<slug:key>/',
+                self.admin_view(self.merged_invoice),
+                name='merged_invoice',
+            ),
         ]
         return my_urls + urls
 
+    def merged_invoice(self, request, key):
+        path = invoices.merged_path(key)
+        if invoices.is_pending(path):
+            response = HttpResponse(
+                'The invoices are being merged, please retry shortly.',
+                status=202,
+            )
+            response['Retry-After'] = '5'
+            return response
+        if not os.path.exists(path):
+            raise Http404('No merged invoice matches the given key.')
+
+        return FileResponse(
+            open(path, 'rb'),
+            as_attachment=True,
+            filename='invoices.pdf',
+            content_type='application/pdf',
+        )
+
     def invoice_for_order(self, request, order_id):
         order = get_object_or_404(models.Order, pk=order_id)
 
         if request.GET.get('format') == 'pdf':
-            html_string = render_to_string(
-                'invoice.html', {'order': order}
-            )
-            html = HTML(
-                string=html_string,
-                base_url=request.build_absolute_uri(),
-            )
+            try:
+                pdf_path = invoices.invoice_pdf(
+                    order, base_url=request.build_absolute_uri()
+                )
+            except exceptions.InvoiceRenderBusy:
+                response = HttpResponse(
+                    'Too many invoices are being generated, '
+                    'please retry shortly.',
+                    status=503,
+                )
+                response['Retry-After'] = '5'
+                return response
+
+            if pdf_path is None:
+                response = HttpResponse(
+                    'The invoice is being generated, '
+                    'please retry shortly.',
+                    status=202,
+                )
+                response['Retry-After'] = '2'
+                return response
 
-            response = HttpResponse(
-                content_type='application/pdf'
+            return FileResponse(
+                open(pdf_path, 'rb'),
+                content_type='application/pdf',
             )
 
-            result = html.write_pdf(response)
-
-            return response
-
         return render(request, 'invoice.html', {'order': order})
 
 
@@ -448,12 +739,47 @@ class CentralOfficeAdminSite(
     site_header = 'BookTime central office administration'
     site_header_color = 'purple'
     module_caption_color = 'pink'
+    extra_reporting_pages = (
+        {'name': 'Chat search', 'link': 'chat-search/'},
+    )
 
     def has_permission(self, request):
         return (
                 request.user.is_active and request.user.is_employee
         )
 
+    def get_urls(self):
+        urls = super().get_urls()
+        my_urls = [
+            path(
+                'chat-search/',
+                self.admin_view(self.chat_search),
+                name='chat_search',
+            ),
+        ]
+        return my_urls + urls
+
+    def chat_search(self, request):
+        form = ChatSearchForm(request.GET or None)
+        results = None
+        next_query = None
+        if form.is_valid():
+            results, cursor = chat_history.search(
+                form.cleaned_data['q'],
+                paginators.parse_cursor(request.GET),
+            )
+            if cursor:
+                next_query = paginators.next_page_query(request.GET, *cursor)
+
+        context = dict(
+            self.each_context(request),
+            title='Chat search',
+            form=form,
+            results=results,
+            next_query=next_query,
+        )
+        return TemplateResponse(request, 'chat_search.html', context)
+
 
 class DispatchersAdminSite(ColoredAdminSite):
     site_header = 'BookTime central dispatch administration'
@@ -465,6 +791,101 @@ class DispatchersAdminSite(ColoredAdminSite):
                 request.user.is_active and request.user.is_dispatcher
         )
 
+    def get_urls(self):
+        urls = super().get_urls()
+        my_urls = [
+            path(
+                'pick-list/',
+                self.admin_view(self.pick_list),
+                name='pick_list',
+            ),
+            path(
+                'dispatch-waves/',
+                self.admin_view(self.dispatch_waves),
+                name='dispatch_waves',
+            ),
+        ]
+        return my_urls + urls
+
+    def pick_list_chunks(self):
+        yield render_to_string('pick_list/head.html')
+        for page in dispatch.pick_list_pages():
+            yield render_to_string(
+                'pick_list/page.html', {'products': page}
+            )
+        yield render_to_string('pick_list/foot.html')
+
+    def pick_list_documents(self):
+        """ Every page of the pick list as a document of its own """
+        head = render_to_string('pick_list/head.html')
+        foot = render_to_string('pick_list/foot.html')
+        empty = True
+        for page in dispatch.pick_list_pages():
+            empty = False
+            yield head + render_to_string(
+                'pick_list/page.html', {'products': page}
+            ) + foot
+        if empty:
+            yield head + foot
+
+    def pick_list(self, request):
+        if request.GET.get('format') == 'pdf':
+            chunks = invoices.pdf_chunks(self.pick_list_documents())
+            try:
+                # Rendering the first page tells if the pool is busy
+                first = next(chunks)
+            except exceptions.InvoiceRenderBusy:
+                response = HttpResponse(
+                    'Too many documents are being generated, '
+                    'please retry shortly.',
+                    status=503,
+                )
+                response['Retry-After'] = '5'
+                return response
+            response = StreamingHttpResponse(
+                itertools.chain([first], chunks),
+                content_type='application/pdf',
+            )
+            response['Content-Disposition'] = (
+                'attachment; filename="pick-list.pdf"'
+            )
+            return response
+
+        return StreamingHttpResponse(self.pick_list_chunks())
+
+    def dispatch_waves(self, request):
+        if request.method == 'POST':
+            form = WavePlanForm(request.POST)
+            if form.is_valid():
+                waves = dispatch.plan_waves(**form.cleaned_data)
+                messages.info(
+                    request, '%d dispatch waves planned' % len(waves)
+                )
+                # Reloading the page must not plan again
+                return redirect('%s:dispatch_waves' % self.name)
+        else:
+            form = WavePlanForm()
+
+        waves = models.DispatchWave.objects.annotate(
+            order_count=Count('orders')
+        ).order_by('-id')[:100]
+        context = dict(
+            self.each_context(request),
+            title='Dispatch waves',
+            form=form,
+            waves=waves,
+        )
+        return TemplateResponse(request, 'dispatch_waves.html', context)
+
+    def index(self, request, extra_context=None):
+        reporting_pages = [
+            {'name': 'Dispatch waves', 'link': 'dispatch-waves/'},
+            {'name': 'Pick list', 'link': 'pick-list/'},
+            {'name': 'Pick list (PDF)', 'link': 'pick-list/?format=pdf'},
+        ]
+        extra_context = {'reporting_pages': reporting_pages}
+        return super().index(request, extra_context)
+
 
 main_admin = OwnersAdminSite()
 main_admin.register(models.Product, ProductAdmin)
@@ -0,0 +1,339 @@
+"""
+Customer service chat history.
+
+Every message is appended to a capped, expiring Redis stream of its
+order, which is what a (re)connecting chat replays without touching the
+database, and its order is added to a pending set. A periodic flush
+copies the entries of pending orders that are newer than the last one
+in the ChatMessage table with one bulk INSERT per order; as both the
+streams and the set live in Redis, messages of a process that dies are
+written by the next flush of any other. Older history is paged from
+the table, topped up with the stream entries not written yet, and the
+table is where transcripts are searched.
+"""
+import asyncio
+import datetime
+import logging
+import re
+import time
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.contrib.postgres.search import SearchQuery
+from django.db import DatabaseError, connection, transaction
+from django.db.models import Q
+
+from . import models
+from .redis_pool import redis_pool
+
+logger = logging.getLogger(__name__)
+
+SEARCH_CONFIG = 'english'
+
+STREAM_ID = re.compile(r'^\d+-\d+$')
+
+
+def key_prefix():
+    return getattr(
+        settings, 'CHAT_HISTORY_KEY_PREFIX', 'customer-service:chat:'
+    )
+
+
+def stream_key(order_id):
+    return '%s%s' % (key_prefix(), order_id)
+
+
+def pending_key():
+    """ Sorted set of the orders with entries maybe not written yet """
+    return '%spending' % key_prefix()
+
+
+def is_stream_id(value):
+    """ Whether value is a stream id, <milliseconds>-<sequence> """
+    return isinstance(value, str) and STREAM_ID.match(value) is not None
+
+
+def parse_stream_id(stream_id):
+    milliseconds, sequence = stream_id.split('-')
+    return int(milliseconds), int(sequence)
+
+
+def next_stream_id(stream_id):
+    """ The smallest id after stream_id, for exclusive ranges """
+    milliseconds, sequence = parse_stream_id(stream_id)
+    return '%d-%d' % (milliseconds, sequence + 1)
+
+
+def previous_stream_id(stream_id):
+    """ The largest id before stream_id, or None """
+    milliseconds, sequence = parse_stream_id(stream_id)
+    if sequence:
+        return '%d-%d' % (milliseconds, sequence - 1)
+    if milliseconds:
+        return '%d-%d' % (milliseconds - 1, 2 ** 64 - 1)
+    return None
+
+
+def stream_date(stream_id):
+    """ Stream ids start with the millisecond timestamp of the entry """
+    milliseconds = int(stream_id.split('-')[0])
+    return datetime.datetime.fromtimestamp(
+        milliseconds / 1000, tz=datetime.timezone.utc
+    )
+
+
+def serialize(message):
+    return {
+        'id': message.stream_id,
+        'username': message.username,
+        'message': message.message,
+        'date': message.date_added.isoformat(),
+    }
+
+
+def serialize_entry(stream_id, fields):
+    return {
+        'id': stream_id,
+        'username': fields[b'username'].decode(),
+        'message': fields[b'message'].decode(),
+        'date': stream_date(stream_id).isoformat(),
+    }
+
+
+async def record(r_conn, order_id, user, text):
+    """
+    Appends a message to the order stream and marks the order pending.
+
+    Streams expire CHAT_HISTORY_STREAM_TTL seconds after their last
+    message; older history is read from the table.
+    """
+    key = stream_key(order_id)
+    pipe = r_conn.pipeline()
+    added = pipe.xadd(
+        key,
+        {
+            'user_id': str(user.pk),
+            'username': user.get_full_name(),
+            'message': text,
+        },
+        max_len=getattr(settings, 'CHAT_HISTORY_STREAM_LENGTH', 500),
+    )
+    pipe.expire(key, getattr(settings, 'CHAT_HISTORY_STREAM_TTL', 86400))
+    pipe.zadd(pending_key(), time.time(), str(order_id))
+    await pipe.execute()
+    writer.wake()
+    return (await added).decode()
+
+
+async def recent(r_conn, order_id, count=None):
+    """ Returns the last messages of an order, oldest first """
+    if count is None:
+        count = getattr(settings, 'CHAT_HISTORY_REPLAY', 50)
+    entries = await r_conn.xrevrange(stream_key(order_id), count=count)
+    return [
+        serialize_entry(stream_id.decode(), fields)
+        for stream_id, fields in reversed(entries)
+    ]
+
+
+def older(order_id, before=None, count=None):
+    """
+    Returns a page of messages sent before the stream id before, oldest
+    first, and whether there are more. Raises ValueError when before is
+    not a stream id.
+    """
+    if count is None:
+        count = getattr(settings, 'CHAT_HISTORY_PAGE_SIZE', 50)
+    messages = models.ChatMessage.objects.filter(order_id=order_id)
+    if before:
+        if not is_stream_id(before):
+            raise ValueError('Invalid stream id %r' % (before,))
+        anchor = (
+            messages.filter(stream_id=before)
+            .values('date_added', 'id')
+            .first()
+        )
+        if anchor:
+            messages = messages.filter(
+                Q(date_added__lt=anchor['date_added'])
+                | Q(date_added=anchor['date_added'], id__lt=anchor['id'])
+            )
+        else:
+            messages = messages.filter(date_added__lt=stream_date(before))
+
+    page = list(messages.order_by('-date_added', '-id')[: count + 1])
+    return [serialize(m) for m in reversed(page[:count])], len(page) > count
+
+
+async def history(r_conn, order_id, before=None, count=None):
+    """
+    Returns a page of messages sent before the stream id before, oldest
+    first, and whether there are more, from the table and the entries
+    of the stream that may not be written yet.
+    """
+    if count is None:
+        count = getattr(settings, 'CHAT_HISTORY_PAGE_SIZE', 50)
+    messages, more = await database_sync_to_async(older)(
+        order_id, before, count
+    )
+    start = previous_stream_id(before) if before else '+'
+    if start is None:
+        return messages, more
+    entries = await r_conn.xrevrange(
+        stream_key(order_id), start=start, count=count + 1
+    )
+    merged = {m['id']: m for m in messages}
+    for stream_id, fields in entries:
+        stream_id = stream_id.decode()
+        merged.setdefault(stream_id, serialize_entry(stream_id, fields))
+    page = sorted(merged.values(), key=lambda m: parse_stream_id(m['id']))
+    return page[-count:], more or len(page) > count
+
+
+def search(query, after=None, count=None):
+    """
+    Returns a page of messages matching query, newest first, and the
+    (date_added, id) cursor of the next page.
+
+    A number is looked up as an order id and an email as the customer
+    of the order; anything else is searched in the message text, with
+    the full-text index on PostgreSQL and a plain icontains elsewhere.
+    """
+    if count is None:
+        count = getattr(settings, 'CHAT_HISTORY_PAGE_SIZE', 50)
+    query = query.strip()
+    messages = models.ChatMessage.objects.select_related(
+        'order__user'
+    ).defer('search_vector')
+    if query.isdigit():
+        messages = messages.filter(order_id=int(query))
+    elif '@' in query:
+        messages = messages.filter(order__user__email__iexact=query)
+    elif connection.vendor == 'postgresql':
+        messages = messages.filter(
+            search_vector=SearchQuery(query, config=SEARCH_CONFIG)
+        )
+    else:
+        messages = messages.filter(message__icontains=query)
+
+    if after:
+        date_added, pk = after
+        messages = messages.filter(
+            Q(date_added__lt=date_added) | Q(date_added=date_added, id__lt=pk)
+        )
+
+    page = list(messages.order_by('-date_added', '-id')[: count + 1])
+    cursor = None
+    if len(page) > count:
+        page = page[:count]
+        cursor = (page[-1].date_added, page[-1].id)
+    return page, cursor
+
+
+class HistoryWriter:
+    """
+    Writes the stream entries of pending orders to the database.
+
+    A flush task runs every CHAT_HISTORY_FLUSH_INTERVAL seconds while
+    orders are pending. Entries are read from the stream after the
+    last one written, so that flushes are idempotent and may run in
+    any process. When a batch cannot be inserted at once, its messages
+    are saved one by one so a single bad row (e.g. of a deleted user)
+    does not lose the others.
+    """
+
+    def __init__(self):
+        self.task = None
+        self.loop = None
+
+    def wake(self):
+        loop = asyncio.get_event_loop()
+        if self.loop is not loop:
+            self.loop = loop
+            self.task = None
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+
+    async def run(self):
+        try:
+            pending = True
+            while pending:
+                await asyncio.sleep(
+                    getattr(settings, 'CHAT_HISTORY_FLUSH_INTERVAL', 2)
+                )
+                try:
+                    pending = await self.flush()
+                except Exception:
+                    logger.exception('Could not flush the chat history')
+        finally:
+            self.task = None
+
+    async def flush(self):
+        """ Writes every pending order; returns whether some are left """
+        r_conn = await redis_pool.get()
+        for order_id in await r_conn.zrange(pending_key()):
+            await self.flush_order(r_conn, order_id.decode())
+        return bool(await r_conn.zcard(pending_key()))
+
+    async def flush_order(self, r_conn, order_id):
+        key = stream_key(order_id)
+        last = await database_sync_to_async(self.last_written)(order_id)
+        entries = await r_conn.xrange(
+            key, start=next_stream_id(last) if last else '-'
+        )
+        if entries:
+            await database_sync_to_async(self.save)(order_id, entries)
+            last = entries[-1][0].decode()
+
+        # Entries added meanwhile put the order back, if zadd has not
+        await r_conn.zrem(pending_key(), order_id)
+        newest = await r_conn.xrevrange(key, count=1)
+        if newest and newest[0][0].decode() != last:
+            await r_conn.zadd(pending_key(), time.time(), order_id)
+
+    def last_written(self, order_id):
+        return (
+            models.ChatMessage.objects.filter(order_id=order_id)
+            .order_by('-date_added', '-id')
+            .values_list('stream_id', flat=True)
+            .first()
+        )
+
+    def save(self, order_id, entries):
+        batch = [
+            models.ChatMessage(
+                order_id=order_id,
+                user_id=int(fields[b'user_id']),
+                username=fields[b'username'].decode(),
+                message=fields[b'message'].decode(),
+                stream_id=stream_id.decode(),
+                date_added=stream_date(stream_id.decode()),
+            )
+            for stream_id, fields in entries
+        ]
+        try:
+            with transaction.atomic():
+                models.ChatMessage.objects.bulk_create(
+                    batch, batch_size=500, ignore_conflicts=True
+                )
+        except DatabaseError:
+            logger.exception(
+                'Could not save %d chat messages at once', len(batch)
+            )
+            for message in batch:
+                try:
+                    with transaction.atomic():
+                        models.ChatMessage.objects.bulk_create(
+                            [message], ignore_conflicts=True
+                        )
+                except DatabaseError:
+                    logger.exception(
+                        'Dropping chat message %s of order %s',
+                        message.stream_id,
+                        message.order_id,
+                    )
+        else:
+            logger.info('Saved %d chat messages', len(batch))
+
+
+writer = HistoryWriter()
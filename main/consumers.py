@@ -1,36 +1,68 @@
 import asyncio
+import json
 import logging
+import time
+from urllib.parse import parse_qs
 
-import aioredis
 import aiohttp
 from channels.db import database_sync_to_async
 from channels.exceptions import StopConsumer
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
 from channels.generic.http import AsyncHttpConsumer
+from django.conf import settings
+from django.http import Http404
 from django.shortcuts import get_object_or_404
-from django.urls import reverse
 
-from . import models
+from . import chat_history, exceptions, models, presence, tracking
+from .log import truncate
+from .metrics import registry
+from .redis_pool import redis_pool
 
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
-fh = logging.FileHandler('consumers.log')
-fh.setLevel(logging.DEBUG)
-logger.addHandler(fh)
 
 class ChatConsumer(AsyncJsonWebsocketConsumer):
     EMPLOYEE = 2
     CLIENT = 1
+    # Seconds during which reconnects of the same employee to the same
+    # order do not touch the database again
+    SPOKEN_TO_DEBOUNCE = 60
+    r_conn = None
+    # order id -> (employee id, time) of the last written last_spoken_to
+    spoken_to = {}
+
+    def note_spoken_to(self, user, order_id):
+        now = time.monotonic()
+        last = ChatConsumer.spoken_to.get(order_id)
+        if last and last[0] == user.pk:
+            if now - last[1] < self.SPOKEN_TO_DEBOUNCE:
+                return
+
+        models.Order.objects.filter(pk=order_id).exclude(
+            last_spoken_to=user
+        ).update(last_spoken_to=user)
+
+        if len(ChatConsumer.spoken_to) > 10000:
+            ChatConsumer.spoken_to = {
+                k: v
+                for k, v in ChatConsumer.spoken_to.items()
+                if now - v[1] < self.SPOKEN_TO_DEBOUNCE
+            }
+        ChatConsumer.spoken_to[order_id] = (user.pk, now)
 
     def get_user_type(self, user, order_id):
-        order = get_object_or_404(models.Order, pk=order_id)
+        order_user_id = (
+            models.Order.objects.filter(pk=order_id)
+            .values_list('user_id', flat=True)
+            .first()
+        )
+        if order_user_id is None:
+            raise Http404('No Order matches the given query.')
 
         if not user.is_anonymous:
             if user.is_employee:
-                order.last_spoken_to = user
-                order.save()
+                self.note_spoken_to(user, order_id)
                 return ChatConsumer.EMPLOYEE
-            elif order.user == user:
+            elif order_user_id == user.pk:
                 return ChatConsumer.CLIENT
             else:
                 return None
@@ -73,14 +105,21 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
             await self.close()
 
         if authorized:
-            self.r_conn = await aioredis.create_redis(
-                'redis://localhost'
-            )
+            self.r_conn = await redis_pool.get()
 
             await self.channel_layer.group_add(
                 self.room_group_name, self.channel_name
             )
             await self.accept()
+
+            messages = await chat_history.recent(
+                self.r_conn, self.order_id
+            )
+            if messages:
+                await self.send_json(
+                    {"type": "history", "messages": messages}
+                )
+
             await self.channel_layer.group_send(
                 self.room_group_name,
                 {
@@ -105,10 +144,26 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
             await self.channel_layer.group_discard(
                 self.room_group_name, self.channel_name
             )
+        self.r_conn = None
 
     async def receive_json(self, content):
         typ = content.get("type")
         if typ == "message":
+            message = content.get("message")
+            if not isinstance(message, str) or not 0 < len(message) <= (
+                getattr(settings, "CHAT_MESSAGE_MAX_LENGTH", 2000)
+            ):
+                logger.warning(
+                    "Ignoring invalid chat message from %s",
+                    self.scope["user"],
+                )
+                return
+            await chat_history.record(
+                self.r_conn,
+                self.order_id,
+                self.scope["user"],
+                message,
+            )
             await self.channel_layer.group_send(
                 self.room_group_name,
                 {
@@ -116,18 +171,32 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
                     "username": self.scope[
                         "user"
                     ].get_full_name(),
-                    "message": content["message"],
+                    "message": message,
                 },
             )
+        elif typ == "history":
+            before = content.get("before")
+            if before is not None and not chat_history.is_stream_id(before):
+                await self.send_json(
+                    {
+                        "type": "history",
+                        "messages": [],
+                        "more": False,
+                        "error": "invalid cursor",
+                    }
+                )
+                return
+            messages, more = await chat_history.history(
+                self.r_conn, self.order_id, before
+            )
+            await self.send_json(
+                {"type": "history", "messages": messages, "more": more}
+            )
         elif typ == "heartbeat":
-            await self.r_conn.setex(
-                "{}_{}_{}".format(
-                    self.room_group_name,
-                    self.scope["user"].email,
-                    'Operator' if self.user_type == 2 else 'Customer'
-                ),
-                10,
-                "1",
+            presence.heartbeats.add(
+                self.order_id,
+                self.scope["user"].email,
+                'Operator' if self.user_type == 2 else 'Customer',
             )
 
     async def chat_message(self, event):
@@ -141,6 +210,8 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
 
 
 class ChatNotifyConsumer(AsyncJsonWebsocketConsumer):
+    subscribed = False
+
     def is_employee_func(self, user):
         return not user.is_anonymous and user.is_employee
 
@@ -165,59 +236,51 @@ class ChatNotifyConsumer(AsyncJsonWebsocketConsumer):
             )
             raise StopConsumer("Unauthorized")
 
-        self.streaming = True
+        self.subscribed = True
+        text = await presence.broadcaster.subscribe(self.channel_name)
+        if text is not None:
+            await self.send(text_data=text)
 
-        r_conn = await aioredis.create_redis_pool('redis://localhost')
-        while self.streaming:
-            active_chats = await r_conn.keys(
-                "customer-service_*"
-            )
-
-            presences = {}
-            for i in active_chats:
-                _, order_id, user_email, status = i.decode("utf8").split(
-                    "_"
-                )
-
-                if order_id in presences:
-                    presences[order_id]['emails'].append(user_email)
-                    # If there already is an operator - do not change the state of chat
-                    if presences[order_id]['status'] != 'Operator':
-                        presences[order_id]['status'] = status
-                else:
-                    presences[order_id] = {'emails': [user_email], 'status': status}
-
-            payload = []
-            for order_id, data in presences.items():
-                payload.append(
-                    {
-                        "link": reverse(
-                            "cs_chat",
-                            kwargs={"order_id": order_id}
-                        ),
-                        "text": "%s (%s)"
-                                % (order_id, ", ".join(data['emails'])),
-                        "status": data['status'],
-                    }
-                )
-
-            logger.info(
-                "Broadcasting presence info to user %s",
-                self.scope["user"],
-            )
-
-            await self.send_json(payload)
-            await asyncio.sleep(5)
+    async def presence_broadcast(self, event):
+        logger.debug(
+            "Broadcasting presence info to user %s",
+            self.scope["user"],
+        )
+        await self.send(text_data=event["text"])
 
     async def disconnect(self, close_code):
         logger.info(
             "Closing notify stream for user %s",
             self.scope.get("user"),
         )
-        self.streaming = False
+        if self.subscribed:
+            self.subscribed = False
+            await presence.broadcaster.unsubscribe(self.channel_name)
+
+
+class MetricsConsumer(AsyncHttpConsumer):
+    """ Process metrics in the Prometheus text format, for staff only """
+
+    async def handle(self, body):
+        user = self.scope.get("user")
+        if user is None or not user.is_staff:
+            await self.send_response(
+                403,
+                b"Forbidden",
+                headers=[(b"Content-Type", b"text/plain")],
+            )
+            return
+
+        await self.send_response(
+            200,
+            registry.render().encode(),
+            headers=[(b"Content-Type", b"text/plain; version=0.0.4")],
+        )
 
 
 class OrderTrackerConsumer(AsyncHttpConsumer):
+    # Age in seconds of the payload when it is served stale
+    stale_age = None
 
     @database_sync_to_async
     def verify_user(self, user, order_id):
@@ -225,11 +288,8 @@ class OrderTrackerConsumer(AsyncHttpConsumer):
         return order.user == user
 
     async def query_remote_server(self, order_id):
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                'https://pastebin.com/raw/b2Niddnk'
-            ) as resp:
-                return await resp.read()
+        payload, self.stale_age = await tracking.client.get(order_id)
+        return payload
 
     async def handle(self, body):
         self.order_id = self.scope['url_route']['kwargs'][
@@ -244,15 +304,136 @@ class OrderTrackerConsumer(AsyncHttpConsumer):
                 f'{self.scope.get("user")} and'
                 f' order {self.order_id}',
             )
-            payload = await self.query_remote_server(self.order_id)
-            logger.info(
-                f'Order tracking response {payload}'
-                f' for user {self.scope.get("user")} and'
-                f' order {self.order_id}',
+            try:
+                payload = await self.query_remote_server(self.order_id)
+            except exceptions.TrackingUnavailable:
+                retry_after = b'%d' % settings.ORDER_TRACKER_RESET_TIMEOUT
+                await self.send_response(
+                    503,
+                    b'Tracking is not available right now',
+                    headers=[(b'Retry-After', retry_after)],
+                )
+                return
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                logger.exception(
+                    f'Order tracking failed for order {self.order_id}'
+                )
+                await self.send_response(
+                    502, b'Tracking is not available right now'
+                )
+                return
+            logger.debug(
+                'Order tracking response %s for user %s and order %s',
+                truncate(payload),
+                self.scope.get("user"),
+                self.order_id,
             )
-            await self.send_response(200, payload)
+            headers = []
+            if self.stale_age is not None:
+                headers = [
+                    (b'Warning', b'110 - "Response is Stale"'),
+                    (b'X-Tracking-Age', b'%d' % self.stale_age),
+                ]
+            await self.send_response(200, payload, headers=headers)
         else:
             logger.error(
                 f'Unauthorized user tracking attempt. OrderID: {self.order_id}. User: {self.scope["cookies"]["username"]}'
             )
-            raise StopConsumer()
\ No newline at end of file
+            raise StopConsumer()
+
+
+class BatchOrderTrackerConsumer(AsyncHttpConsumer):
+    """
+    Tracking of many orders of the user in one request.
+
+    Order ids are passed as ?ids=1,2,3. Ownership is checked with one
+    query, lookups run concurrently (at most
+    ORDER_TRACKER_BATCH_CONCURRENCY at a time) through the tracking
+    cache, and one JSON line per order is streamed as soon as it is
+    known.
+    """
+
+    @database_sync_to_async
+    def owned_orders(self, user, order_ids):
+        return set(
+            models.Order.objects.filter(
+                user=user, pk__in=order_ids
+            ).values_list('id', flat=True)
+        )
+
+    def parse_ids(self):
+        params = parse_qs(self.scope['query_string'].decode())
+        try:
+            ids = [
+                int(i)
+                for value in params.get('ids', [])
+                for i in value.split(',')
+                if i
+            ]
+        except ValueError:
+            return None
+        # Keep the order of the request, without duplicates
+        return list(dict.fromkeys(ids))
+
+    async def track(self, semaphore, order_id):
+        async with semaphore:
+            try:
+                payload, stale_age = await tracking.client.get(order_id)
+            except exceptions.TrackingUnavailable:
+                return {'order_id': order_id, 'error': 'unavailable'}
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                return {'order_id': order_id, 'error': 'upstream'}
+        return {
+            'order_id': order_id,
+            'tracking': payload.decode('utf8', 'replace'),
+            'stale_age': stale_age,
+        }
+
+    async def send_line(self, data):
+        await self.send_body(
+            json.dumps(data).encode() + b'\n', more_body=True
+        )
+
+    async def handle(self, body):
+        user = self.scope['user']
+        order_ids = self.parse_ids()
+        max_ids = settings.ORDER_TRACKER_BATCH_SIZE
+        if user.is_anonymous:
+            await self.send_response(403, b'Forbidden')
+            return
+        if not order_ids or len(order_ids) > max_ids:
+            await self.send_response(
+                400, b'Pass between 1 and %d order ids' % max_ids
+            )
+            return
+
+        owned = await self.owned_orders(user, order_ids)
+        logger.info(
+            f'Batch order tracking request for user {user}'
+            f' and {len(order_ids)} orders',
+        )
+
+        await self.send_headers(
+            headers=[(b'Content-Type', b'application/x-ndjson')]
+        )
+        for order_id in order_ids:
+            if order_id not in owned:
+                await self.send_line(
+                    {'order_id': order_id, 'error': 'not found'}
+                )
+
+        semaphore = asyncio.Semaphore(
+            settings.ORDER_TRACKER_BATCH_CONCURRENCY
+        )
+        tasks = [
+            asyncio.ensure_future(self.track(semaphore, order_id))
+            for order_id in order_ids
+            if order_id in owned
+        ]
+        try:
+            for result in asyncio.as_completed(tasks):
+                await self.send_line(await result)
+        finally:
+            for task in tasks:
+                task.cancel()
+        await self.send_body(b'')
@@ -0,0 +1,125 @@
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import Count
+
+from . import models
+
+PICK_LIST_PAGE_SIZE = 40
+WAVE_CAPACITY = 50
+ZIP_PREFIX_LENGTH = 2
+
+
+def pick_list_lines():
+    """ Open lines of PAID orders, counted per product and order """
+    return (
+        models.OrderLine.objects.filter(
+            order__status=models.Order.PAID,
+            status__in=(
+                models.OrderLine.NEW,
+                models.OrderLine.PROCESSING,
+            ),
+        )
+        .values('product_id', 'product__name', 'order_id')
+        .annotate(quantity=Count('id'))
+        .order_by('product__name', 'product_id', 'order_id')
+    )
+
+
+def pick_list_pages(page_size=PICK_LIST_PAGE_SIZE):
+    """
+    Yields the pick list as pages of products.
+
+    Every product carries its total quantity and the per-order
+    breakdown. The grouped query is read with a cursor, so only one
+    page is held in memory at a time.
+    """
+    page = []
+    product = None
+    for line in pick_list_lines().iterator():
+        if product is None or product['id'] != line['product_id']:
+            if len(page) == page_size:
+                yield page
+                page = []
+            product = {
+                'id': line['product_id'],
+                'name': line['product__name'],
+                'quantity': 0,
+                'orders': [],
+            }
+            page.append(product)
+        product['quantity'] += line['quantity']
+        product['orders'].append((line['order_id'], line['quantity']))
+    if page:
+        yield page
+
+
+def zip_prefix(zip_code, length=ZIP_PREFIX_LENGTH):
+    return ''.join(c for c in zip_code.upper() if c.isalnum())[:length]
+
+
+def group_waves(
+    orders, capacity=WAVE_CAPACITY, prefix_length=ZIP_PREFIX_LENGTH
+):
+    """
+    Splits (id, country, zip_code) tuples into waves.
+
+    Orders are grouped by country and ZIP prefix in memory. A wave
+    never spans two countries, so it goes to a single carrier, and
+    every country is served by the fewest waves its order count
+    allows. Neighbouring prefixes are kept in the same wave.
+    Returns a list of (country, prefixes, order_ids).
+    """
+    groups = defaultdict(lambda: defaultdict(list))
+    for order_id, country, zip_code in orders:
+        groups[country][zip_prefix(zip_code, prefix_length)].append(
+            order_id
+        )
+
+    waves = []
+    for country in sorted(groups):
+        order_ids = []
+        prefixes = []
+        for prefix in sorted(groups[country]):
+            pending = groups[country][prefix]
+            while pending:
+                space = capacity - len(order_ids)
+                order_ids.extend(pending[:space])
+                pending = pending[space:]
+                if prefix not in prefixes:
+                    prefixes.append(prefix)
+                if len(order_ids) == capacity:
+                    waves.append((country, prefixes, order_ids))
+                    order_ids = []
+                    prefixes = []
+        if order_ids:
+            waves.append((country, prefixes, order_ids))
+    return waves
+
+
+def plan_waves(capacity=WAVE_CAPACITY, prefix_length=ZIP_PREFIX_LENGTH):
+    """
+    Assigns every PAID order that is not in a wave yet to a new wave.
+
+    Orders are read with a single query and each wave is saved with
+    one UPDATE. Returns the created waves.
+    """
+    created = []
+    with transaction.atomic():
+        # Orders locked by a concurrent run are left to it
+        orders = models.Order.objects.filter(
+            status=models.Order.PAID, dispatch_wave__isnull=True
+        ).select_for_update(skip_locked=True).order_by('id').values_list(
+            'id', 'shipping_country', 'shipping_zip_code'
+        )
+        for country, prefixes, order_ids in group_waves(
+            orders.iterator(), capacity, prefix_length
+        ):
+            wave = models.DispatchWave.objects.create(
+                country=country, zip_prefixes=', '.join(prefixes)[:255]
+            )
+            models.Order.objects.filter(pk__in=order_ids).update(
+                dispatch_wave=wave
+            )
+            created.append(wave)
+    return created
@@ -3,6 +3,7 @@ from rest_framework.decorators import (
     api_view,
     permission_classes,
 )
+from rest_framework.exceptions import PermissionDenied
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from . import models
@@ -62,4 +63,35 @@ def my_orders(request):
                 'price': order.total_price,
             }
         )
-    return Response(data)
\ No newline at end of file
+    return Response(data)
+
+
+class DispatchSerializer(serializers.Serializer):
+    STATUSES = {
+        'processing': models.OrderLine.PROCESSING,
+        'sent': models.OrderLine.SENT,
+    }
+
+    orders = serializers.ListField(
+        child=serializers.IntegerField(), allow_empty=False
+    )
+    status = serializers.ChoiceField(choices=list(STATUSES))
+
+
+@api_view(['POST'])
+@permission_classes((IsAuthenticated,))
+def dispatch_orders(request):
+    if not request.user.is_dispatcher:
+        raise PermissionDenied()
+
+    serializer = DispatchSerializer(data=request.data)
+    serializer.is_valid(raise_exception=True)
+    updated = models.Order.objects.dispatch_lines(
+        models.Order.objects.filter(
+            pk__in=serializer.validated_data['orders']
+        ),
+        DispatchSerializer.STATUSES[
+            serializer.validated_data['status']
+        ],
+    )
+    return Response({'lines_updated': updated})
@@ -1,2 +1,10 @@
 class BasketException(Exception):
-    pass
\ No newline at end of file
+    pass
+
+
+class InvoiceRenderBusy(Exception):
+    pass
+
+
+class TrackingUnavailable(Exception):
+    pass
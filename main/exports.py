@@ -0,0 +1,57 @@
+import csv
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import Http404, StreamingHttpResponse
+
+CHUNK_SIZE = 2000
+
+FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+class Echo:
+    """ File-like object handing every written line back to the caller """
+
+    def write(self, value):
+        return value
+
+
+def csv_lines(rows, fields):
+    writer = csv.writer(Echo())
+    yield writer.writerow(fields)
+    for row in rows:
+        yield writer.writerow([row[f] for f in fields])
+
+
+def ndjson_lines(rows, fields):
+    for row in rows:
+        yield json.dumps(
+            {f: row[f] for f in fields}, cls=DjangoJSONEncoder
+        ) + '\n'
+
+
+def export_response(rows, fields, filename, fmt):
+    """
+    Streams rows (an iterable of dicts) as CSV or NDJSON.
+
+    Querysets should be passed through .iterator() so rows are fetched
+    with a server-side cursor chunk by chunk instead of all at once.
+    """
+    if fmt not in FORMATS:
+        raise Http404('Unsupported export format')
+
+    lines = csv_lines if fmt == 'csv' else ndjson_lines
+    response = StreamingHttpResponse(
+        lines(rows, fields), content_type=FORMATS[fmt]
+    )
+    response['Content-Disposition'] = (
+        'attachment; filename="%s.%s"' % (filename, fmt)
+    )
+    return response
+
+
+def queryset_rows(queryset, fields):
+    return queryset.values(*fields).iterator(chunk_size=CHUNK_SIZE)
@@ -0,0 +1,586 @@
+import copy
+import glob
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import (
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    TimeoutError,
+)
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+
+import django
+from django.conf import settings
+from django.contrib.staticfiles import finders
+from django.db import connection
+from django.template.loader import render_to_string
+from pypdf import PdfReader
+from pypdf.generic import ArrayObject, DictionaryObject, IndirectObject
+from weasyprint import CSS, HTML
+
+from . import exceptions, models
+
+logger = logging.getLogger(__name__)
+
+INVOICE_STYLESHEET = 'css/bootstrap.min.css'
+
+_executor = None
+_merge_executor = None
+_process_pool = None
+_in_flight = {}
+# _lock guards _in_flight, _pool_lock the creation of the pools
+_lock = threading.Lock()
+_pool_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def invoice_stylesheet():
+    """
+    Parses the invoice stylesheet once per process.
+
+    WeasyPrint would otherwise fetch and parse bootstrap through the
+    <link> tag on every render.
+    """
+    return CSS(filename=finders.find(INVOICE_STYLESHEET))
+
+
+def cache_dir():
+    return getattr(
+        settings,
+        'INVOICE_CACHE_DIR',
+        os.path.join(settings.BASE_DIR, 'var', 'invoices'),
+    )
+
+
+def version(order):
+    """ Fixed width, so that versions sort as strings """
+    return order.date_updated.strftime('%Y%m%d%H%M%S%f')
+
+
+def cache_path(order):
+    return os.path.join(
+        cache_dir(), '%d-%s.pdf' % (order.id, version(order))
+    )
+
+
+def render_html(order):
+    return render_to_string(
+        'invoice.html', {'order': order, 'pdf': True}
+    )
+
+
+def write_pdf(html_string, path, base_url=None):
+    """
+    Renders html_string into path and removes the older versions.
+
+    A render finishing after the one of a newer version leaves the
+    newer file in place.
+    """
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            HTML(string=html_string, base_url=base_url).write_pdf(
+                f, stylesheets=[invoice_stylesheet()]
+            )
+        os.replace(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+    name = os.path.basename(path)
+    order_prefix = name.split('-')[0]
+    for stale in glob.glob(
+        os.path.join(directory, '%s-*.pdf' % order_prefix)
+    ):
+        if os.path.basename(stale) < name:
+            try:
+                os.unlink(stale)
+            except FileNotFoundError:
+                pass
+    return path
+
+
+def write_invoice(order, path, base_url=None):
+    """ Renders the invoice of order into path, on a worker thread """
+    try:
+        return write_pdf(render_html(order), path, base_url)
+    finally:
+        # Worker threads would keep their connection open otherwise
+        connection.close()
+
+
+def get_executor():
+    global _executor
+    with _pool_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, 'INVOICE_RENDER_WORKERS', 2),
+                thread_name_prefix='invoice',
+            )
+        return _executor
+
+
+def get_merge_executor():
+    """ Merges run apart from the threads rendering single invoices """
+    global _merge_executor
+    with _pool_lock:
+        if _merge_executor is None:
+            _merge_executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, 'INVOICE_MERGE_WORKERS', 1),
+                thread_name_prefix='invoice-merge',
+            )
+        return _merge_executor
+
+
+def get_process_pool(processes=None):
+    """
+    Returns the process pool rendering invoice batches.
+
+    It is created on first use and kept for the life of the process;
+    processes only applies to its creation.
+    """
+    global _process_pool
+    with _pool_lock:
+        if _process_pool is None:
+            _process_pool = ProcessPoolExecutor(
+                max_workers=processes
+                or getattr(settings, 'INVOICE_BATCH_PROCESSES', None),
+                initializer=django.setup,
+            )
+        return _process_pool
+
+
+def reset_process_pool():
+    global _process_pool
+    with _pool_lock:
+        pool, _process_pool = _process_pool, None
+    if pool is not None:
+        pool.shutdown(wait=False)
+
+
+def run_once(path, fn, *args):
+    """
+    Runs fn(*args) on the worker pool, unless path is being written.
+
+    Concurrent requests for the same file share one job. Raises
+    InvoiceRenderBusy when the pool already has a full queue.
+    """
+    queue_size = getattr(settings, 'INVOICE_RENDER_QUEUE_SIZE', 8)
+    future = Future()
+    with _lock:
+        running = _in_flight.get(path)
+        if running is not None:
+            return running
+        if len(_in_flight) >= queue_size:
+            raise exceptions.InvoiceRenderBusy(
+                'Too many invoices are being rendered'
+            )
+        _in_flight[path] = future
+
+    def job():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            result = fn(*args)
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+
+    def done(_):
+        with _lock:
+            _in_flight.pop(path, None)
+
+    future.add_done_callback(done)
+    try:
+        get_executor().submit(job)
+    except RuntimeError as e:
+        future.set_exception(e)
+        raise
+    return future
+
+
+def submit(order, base_url=None):
+    """ Schedules the PDF rendering of an order on the worker pool """
+    path = cache_path(order)
+    logger.info('Rendering invoice PDF for order %d', order.id)
+    return run_once(path, write_invoice, order, path, base_url)
+
+
+def invoice_pdf(order, base_url=None, timeout=None):
+    """
+    Returns the path of the cached invoice PDF of an order.
+
+    Rendering is triggered when the cache is cold; None is returned
+    if it does not finish within timeout seconds, in which case it
+    keeps running in the background.
+    """
+    path = cache_path(order)
+    if os.path.exists(path):
+        return path
+
+    if timeout is None:
+        timeout = getattr(settings, 'INVOICE_RENDER_TIMEOUT', 10)
+    try:
+        return submit(order, base_url).result(timeout=timeout)
+    except TimeoutError:
+        return None
+
+
+def iter_order_batches(queryset, batch_size=100):
+    """ Yields lists of orders with their lines and products prefetched """
+    queryset = queryset.order_by('pk').prefetch_related('lines__product')
+    last_pk = 0
+    while True:
+        batch = list(queryset.filter(pk__gt=last_pk)[:batch_size])
+        if not batch:
+            return
+        yield batch
+        last_pk = batch[-1].pk
+
+
+def render_batch(queryset, processes=None, batch_size=100):
+    """
+    Yields (order, pdf_path) for every order of queryset, in pk order.
+
+    Invoices missing from the cache are rendered in parallel across
+    the process pool, one batch of orders at a time.
+    """
+    pool = get_process_pool(processes)
+    for orders in iter_order_batches(queryset, batch_size):
+        jobs = []
+        for order in orders:
+            path = cache_path(order)
+            future = None
+            if not os.path.exists(path):
+                try:
+                    future = pool.submit(
+                        write_pdf, render_html(order), path
+                    )
+                except BrokenProcessPool:
+                    reset_process_pool()
+                    raise
+            jobs.append((order, path, future))
+
+        for order, path, future in jobs:
+            if future is not None:
+                try:
+                    future.result()
+                except BrokenProcessPool:
+                    reset_process_pool()
+                    raise
+            yield order, path
+
+
+class ZipStream:
+    """ Write-only stream whose content is drained as the zip is built """
+
+    def __init__(self):
+        self.chunks = []
+        self.offset = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def zip_chunks(rendered):
+    """ Yields a zip archive of rendered invoices, one file at a time """
+    stream = ZipStream()
+    with zipfile.ZipFile(stream, 'w', zipfile.ZIP_STORED) as archive:
+        for order, path in rendered:
+            archive.write(path, 'invoice-BT%d.pdf' % order.id)
+            yield stream.drain()
+    yield stream.drain()
+
+
+class PdfAppender:
+    """
+    Writes a PDF made of the pages of other PDFs, one file at a time.
+
+    The objects of every appended file are renumbered and written out
+    as soon as they are read, so memory holds a single input document
+    plus an offset per object; the page tree, catalog and cross
+    reference table are written by close().
+    """
+
+    PAGES = 1
+    CATALOG = 2
+
+    def __init__(self, target):
+        self.target = target
+        self.offset = 0
+        # Index 0 is the free head of the xref table
+        self.offsets = [0, None, None]
+        self.kids = []
+        self.write(b'%PDF-1.7\n%\xe2\xe3\xcf\xd3\n')
+
+    def write(self, data):
+        self.target.write(data)
+        self.offset += len(data)
+
+    def write_object(self, number, obj):
+        self.offsets[number] = self.offset
+        self.write(b'%d 0 obj\n' % number)
+        obj.write_to_stream(self)
+        self.write(b'\nendobj\n')
+
+    def append(self, path):
+        reader = PdfReader(path)
+        numbers = {}
+        pending = []
+
+        def number(ref):
+            key = (ref.idnum, ref.generation)
+            if key not in numbers:
+                numbers[key] = len(self.offsets)
+                self.offsets.append(None)
+                pending.append(ref)
+            return numbers[key]
+
+        def renumber(obj):
+            if isinstance(obj, IndirectObject):
+                return IndirectObject(number(obj), 0, None)
+            if isinstance(obj, DictionaryObject):
+                new = copy.copy(obj)
+                for key, value in obj.items():
+                    # The page tree of the input is not copied
+                    if key == '/Parent' and obj.get('/Type') == '/Page':
+                        new[key] = IndirectObject(self.PAGES, 0, None)
+                    else:
+                        new[key] = renumber(value)
+                return new
+            if isinstance(obj, ArrayObject):
+                return ArrayObject(renumber(value) for value in obj)
+            return obj
+
+        # Loading the pages copies inherited attributes into them
+        for page in reader.pages:
+            self.kids.append(number(page.indirect_reference))
+        while pending:
+            ref = pending.pop()
+            self.write_object(
+                numbers[(ref.idnum, ref.generation)],
+                renumber(ref.get_object()),
+            )
+
+    def close(self):
+        """ Returns False, and writes nothing more, without any page """
+        if not self.kids:
+            return False
+        kids = ' '.join('%d 0 R' % kid for kid in self.kids)
+        for number, body in (
+            (
+                self.PAGES,
+                '<< /Type /Pages /Kids [ %s ] /Count %d >>'
+                % (kids, len(self.kids)),
+            ),
+            (
+                self.CATALOG,
+                '<< /Type /Catalog /Pages %d 0 R >>' % self.PAGES,
+            ),
+        ):
+            self.offsets[number] = self.offset
+            self.write(b'%d 0 obj\n%s\nendobj\n' % (number, body.encode()))
+
+        xref = self.offset
+        self.write(b'xref\n0 %d\n' % len(self.offsets))
+        self.write(b'0000000000 65535 f \n')
+        for offset in self.offsets[1:]:
+            self.write(b'%010d 00000 n \n' % offset)
+        self.write(
+            b'trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n'
+            % (len(self.offsets), self.CATALOG, xref)
+        )
+        return True
+
+
+def write_merged_pdf(queryset, target, processes=None, batch_size=100):
+    """
+    Writes the invoices of queryset as a single PDF into target.
+
+    Invoices are rendered into the PDF cache batch by batch and copied
+    to target one after the other, so neither the page layouts nor
+    the merged document are held in memory. Returns False when there
+    is no order to write.
+    """
+    appender = PdfAppender(target)
+    for order, path in render_batch(queryset, processes, batch_size):
+        appender.append(path)
+    return appender.close()
+
+
+def render_when_free(path, html_string, base_url=None):
+    """
+    Renders html_string into path on the worker pool, waiting up to
+    INVOICE_RENDER_TIMEOUT seconds for a free slot in its queue.
+    """
+    deadline = time.monotonic() + getattr(
+        settings, 'INVOICE_RENDER_TIMEOUT', 10
+    )
+    while True:
+        try:
+            future = run_once(path, write_pdf, html_string, path, base_url)
+        except exceptions.InvoiceRenderBusy:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+        else:
+            return future.result()
+
+
+def pdf_chunks(documents, base_url=None):
+    """
+    Yields a single PDF made of the HTML documents, one document at a
+    time: each is rendered on the worker pool, appended and dropped
+    before the next one is rendered.
+    """
+    directory = tempfile.mkdtemp(prefix='pdf-chunks-')
+    stream = ZipStream()
+    appender = PdfAppender(stream)
+    try:
+        for number, html_string in enumerate(documents):
+            path = render_when_free(
+                os.path.join(directory, '%d.pdf' % number),
+                html_string,
+                base_url,
+            )
+            appender.append(path)
+            os.unlink(path)
+            yield stream.drain()
+        appender.close()
+        yield stream.drain()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def merged_key(queryset):
+    """ Identifies a set of orders in the versions they have now """
+    versions = queryset.order_by('pk').values_list('pk', 'date_updated')
+    return hashlib.sha1(
+        ';'.join(
+            '%d-%s' % (pk, date_updated.strftime('%Y%m%d%H%M%S%f'))
+            for pk, date_updated in versions
+        ).encode()
+    ).hexdigest()
+
+
+def merged_path(key):
+    return os.path.join(cache_dir(), 'merged', '%s.pdf' % key)
+
+
+def part_path(path):
+    """ Where the merge into path is written, seen by every process """
+    return path + '.part'
+
+
+def is_pending(path):
+    """
+    Whether a merge into path is running, in any process. A part file
+    left untouched for INVOICE_MERGE_TIMEOUT seconds is one whose
+    process died.
+    """
+    try:
+        modified = os.path.getmtime(part_path(path))
+    except FileNotFoundError:
+        return False
+    timeout = getattr(settings, 'INVOICE_MERGE_TIMEOUT', 600)
+    return time.time() - modified < timeout
+
+
+def claim(path):
+    """ Creates the part file of path; False if another merge has it """
+    part = part_path(path)
+    os.makedirs(os.path.dirname(part), exist_ok=True)
+    if os.path.exists(part) and not is_pending(path):
+        try:
+            os.unlink(part)
+        except FileNotFoundError:
+            pass
+    try:
+        os.close(os.open(part, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        return False
+    return True
+
+
+def remove_expired_merges():
+    max_age = getattr(settings, 'INVOICE_MERGE_MAX_AGE', 86400)
+    for merged in glob.glob(os.path.join(cache_dir(), 'merged', '*.pdf')):
+        try:
+            if time.time() - os.path.getmtime(merged) > max_age:
+                os.unlink(merged)
+        except FileNotFoundError:
+            pass
+
+
+def write_merged_file(order_ids, path):
+    """ Writes the merged invoice of order_ids through its part file """
+    part = part_path(path)
+    try:
+        with open(part, 'wb') as f:
+            write_merged_pdf(
+                models.Order.objects.filter(pk__in=order_ids), f
+            )
+        os.replace(part, path)
+    except Exception:
+        logger.exception(
+            'Merging the invoices of %d orders failed', len(order_ids)
+        )
+        os.unlink(part)
+        raise
+    finally:
+        # Worker threads would keep their connection open otherwise
+        connection.close()
+    return path
+
+
+def submit_merged(queryset):
+    """
+    Schedules the merge of the invoices of queryset in the background,
+    unless it is written or being written. Returns the key of the
+    merged PDF, see merged_path.
+    """
+    key = merged_key(queryset)
+    path = merged_path(key)
+    if not os.path.exists(path) and claim(path):
+        remove_expired_merges()
+        order_ids = list(queryset.values_list('pk', flat=True))
+        logger.info('Merging the invoices of %d orders', len(order_ids))
+        get_merge_executor().submit(write_merged_file, order_ids, path)
+    return key
+
+
+def file_chunks(path, chunk_size=64 * 1024, delete=False):
+    try:
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    return
+                yield chunk
+    finally:
+        if delete:
+            os.unlink(path)
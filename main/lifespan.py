@@ -0,0 +1,41 @@
+"""
+ASGI lifespan handling.
+
+Servers implementing the lifespan protocol (uvicorn, hypercorn) send a
+shutdown event before stopping, on which the background tasks of the
+process are stopped, what they buffer is written and the connections
+are closed. Daphne does not send lifespan events: under Daphne, chat
+messages not written yet stay in their Redis streams and are written
+by the next process to flush them, heartbeats expire on their own and
+connections are dropped when the process exits.
+"""
+import logging
+
+from . import chat_history, presence, tracking
+from .redis_pool import redis_pool
+
+logger = logging.getLogger(__name__)
+
+
+async def shutdown():
+    logger.info('Shutting down')
+    await presence.broadcaster.stop()
+    await presence.heartbeats.stop()
+    await chat_history.writer.flush()
+    await tracking.client.close()
+    await redis_pool.close()
+
+
+class Lifespan:
+    def __init__(self, scope):
+        self.scope = scope
+
+    async def __call__(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
@@ -0,0 +1,63 @@
+"""
+Logging helpers for code running on the event loop.
+"""
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+PAYLOAD_LOG_LIMIT = 200
+
+
+class BlockingStopListener(QueueListener):
+    def enqueue_sentinel(self):
+        # The queue may be full; stopping can wait for the thread
+        self.queue.put(self._sentinel)
+
+
+class QueueFileHandler(QueueHandler):
+    """
+    Writes to a file from a listener thread.
+
+    Emitting a record only formats it and puts it on a bounded queue,
+    so async consumers never wait for the disk; records are dropped
+    (and counted) when the queue is full. Configured from LOGGING like
+    a FileHandler:
+
+        'class': 'main.log.QueueFileHandler',
+        'filename': 'consumers.log',
+    """
+
+    def __init__(self, filename, mode='a', encoding=None, maxsize=10000):
+        super().__init__(queue.Queue(maxsize))
+        self.dropped = 0
+        self.file_handler = logging.FileHandler(
+            filename, mode, encoding, delay=True
+        )
+        self.listener = BlockingStopListener(
+            self.queue, self.file_handler
+        )
+        self.listener.start()
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+            self.file_handler.close()
+        super().close()
+
+
+def truncate(payload, limit=PAYLOAD_LOG_LIMIT):
+    """ Shortens a payload for logging, keeping its total size """
+    if isinstance(payload, bytes):
+        text = payload[:limit].decode('utf8', 'replace')
+    else:
+        text = str(payload)[:limit]
+    if len(payload) > limit:
+        text += '... (%d in total)' % len(payload)
+    return text
@@ -0,0 +1,173 @@
+import csv
+import json
+import os.path
+import shutil
+import tempfile
+import time
+import tracemalloc
+from io import StringIO
+
+from PIL import Image
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import override_settings
+from main import factories
+
+
+class Rollback(Exception):
+    pass
+
+
+class QueryTimer:
+    """ Execute wrapper counting queries and the time spent in them """
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.seconds += time.perf_counter() - start
+            self.queries += 1
+
+
+class Command(BaseCommand):
+    help = "Benchmark import_data against synthetic catalogs"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sizes",
+            type=int,
+            nargs="+",
+            default=[1000, 10000, 100000],
+        )
+        parser.add_argument("--tags", type=int, default=20)
+        parser.add_argument("--tags-per-product", type=int, default=2)
+        parser.add_argument("--images", type=int, default=10)
+        parser.add_argument("--output", type=str, default=None)
+        parser.add_argument(
+            "--trace-memory",
+            action="store_true",
+            help="Report the peak of Python allocations of each size; "
+            "tracing slows the import down, so timings are not "
+            "comparable with untraced runs",
+        )
+
+    def generate_catalog(self, basedir, size, options):
+        """ Writes a CSV and a pool of small JPEGs into basedir """
+        image_names = []
+        for i in range(options["images"]):
+            name = "image-%d.jpg" % i
+            colour = (i * 37 % 256, i * 91 % 256, i * 53 % 256)
+            Image.new("RGB", (64, 64), colour).save(
+                os.path.join(basedir, name), "JPEG"
+            )
+            image_names.append(name)
+
+        tags = ["tag-%d" % i for i in range(options["tags"])]
+        csv_path = os.path.join(basedir, "catalog.csv")
+        with open(csv_path, "w", newline="") as f:
+            writer = csv.DictWriter(
+                f,
+                fieldnames=[
+                    "name",
+                    "description",
+                    "tags",
+                    "image_filename",
+                    "price",
+                ],
+            )
+            writer.writeheader()
+            for i in range(size):
+                product = factories.ProductFactory.build(
+                    name="Book %d" % i
+                )
+                writer.writerow(
+                    {
+                        "name": product.name,
+                        "description": "Synthetic book %d" % i,
+                        "tags": "|".join(
+                            tags[(i + j) % len(tags)]
+                            for j in range(options["tags_per_product"])
+                        ),
+                        "image_filename": image_names[
+                            i % len(image_names)
+                        ],
+                        "price": product.price,
+                    }
+                )
+        return csv_path
+
+    def run_import(self, size, options):
+        basedir = tempfile.mkdtemp(prefix="booktime-bench-")
+        media_root = os.path.join(basedir, "media")
+        timer = QueryTimer()
+        tracing = options["trace_memory"] and not tracemalloc.is_tracing()
+        peak = None
+        try:
+            csv_path = self.generate_catalog(basedir, size, options)
+            if tracing:
+                # Started for each size, so that peaks are not carried
+                # over from larger runs
+                tracemalloc.start()
+            start = time.perf_counter()
+            # Everything is rolled back so the benchmark can run
+            # against any database without leaving data behind
+            try:
+                with override_settings(MEDIA_ROOT=media_root):
+                    with transaction.atomic():
+                        with connection.execute_wrapper(timer):
+                            call_command(
+                                "import_data",
+                                csv_path,
+                                basedir,
+                                stdout=StringIO(),
+                            )
+                        raise Rollback()
+            except Rollback:
+                pass
+            elapsed = time.perf_counter() - start
+            if tracing:
+                peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            if tracing:
+                tracemalloc.stop()
+            shutil.rmtree(basedir, ignore_errors=True)
+
+        return {
+            "mode": "import_data",
+            "rows": size,
+            "seconds": round(elapsed, 3),
+            "rows_per_second": round(size / elapsed, 1),
+            "queries": timer.queries,
+            "queries_per_row": round(timer.queries / size, 2),
+            "db_seconds": round(timer.seconds, 3),
+            # Time outside the database: CSV parsing, thumbnail
+            # generation and file storage
+            "non_db_seconds": round(elapsed - timer.seconds, 3),
+            # Python allocations only; Pillow's pixel buffers are not
+            # traced
+            "peak_traced_kb": (
+                round(peak / 1024, 1) if peak is not None else None
+            ),
+        }
+
+    def handle(self, *args, **options):
+        results = []
+        for size in options["sizes"]:
+            self.stderr.write("Benchmarking %d rows" % size)
+            results.append(self.run_import(size, options))
+
+        report = json.dumps(
+            {"database": connection.vendor, "results": results},
+            indent=2,
+        )
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(report)
+        else:
+            self.stdout.write(report)
@@ -0,0 +1,56 @@
+from datetime import datetime, time, timedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from main import invoices, models
+
+
+def parse_day(value):
+    return datetime.strptime(value, "%Y-%m-%d").date()
+
+
+class Command(BaseCommand):
+    help = "Generate invoices of the orders added in a date range"
+
+    def add_arguments(self, parser):
+        parser.add_argument("date_from", type=parse_day)
+        parser.add_argument("date_to", type=parse_day)
+        parser.add_argument(
+            "output", type=str, help="Path of a .zip or .pdf file"
+        )
+        parser.add_argument("--processes", type=int, default=None)
+        parser.add_argument("--batch-size", type=int, default=100)
+
+    def handle(self, *args, **options):
+        output = options["output"]
+        if not output.endswith((".zip", ".pdf")):
+            raise CommandError("Output must be a .zip or .pdf file")
+
+        start = timezone.make_aware(
+            datetime.combine(options["date_from"], time.min)
+        )
+        end = timezone.make_aware(
+            datetime.combine(options["date_to"], time.min)
+        ) + timedelta(days=1)
+        orders = models.Order.objects.filter(
+            date_added__gte=start, date_added__lt=end
+        )
+        self.stdout.write("Generating invoices for %d orders" % orders.count())
+
+        with open(output, "wb") as f:
+            if output.endswith(".pdf"):
+                invoices.write_merged_pdf(
+                    orders,
+                    f,
+                    processes=options["processes"],
+                    batch_size=options["batch_size"],
+                )
+            else:
+                rendered = invoices.render_batch(
+                    orders,
+                    processes=options["processes"],
+                    batch_size=options["batch_size"],
+                )
+                for chunk in invoices.zip_chunks(rendered):
+                    f.write(chunk)
+
+        self.stdout.write("Invoices written to %s" % output)
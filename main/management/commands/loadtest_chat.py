@@ -0,0 +1,328 @@
+import asyncio
+import json
+import time
+import tracemalloc
+
+from channels.db import database_sync_to_async
+from channels.layers import (
+    DEFAULT_CHANNEL_LAYER,
+    InMemoryChannelLayer,
+    channel_layers,
+)
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth.models import Group
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+from main import chat_history, consumers, models, presence
+from main.redis_pool import redis_pool
+
+EMAIL_DOMAIN = "loadtest.invalid"
+MESSAGE_PREFIX = "loadtest "
+CHAT_KEY_PREFIX = "loadtest:chat:"
+
+
+def percentile(values, p):
+    """ Nearest-rank percentile of sorted values """
+    if not values:
+        return None
+    last = len(values) - 1
+    return values[min(last, int(round(p / 100 * last)))]
+
+
+class Command(BaseCommand):
+    help = (
+        "Load test the chat and notify consumers in a single process. "
+        "Users and orders are created in the database and deleted "
+        "afterwards; presence is written to Redis, which must be either "
+        "fakeredis or, explicitly, REDIS_URL."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--clients", type=int, default=50)
+        parser.add_argument("--employees", type=int, default=5)
+        parser.add_argument(
+            "--messages",
+            type=int,
+            default=10,
+            help="Messages sent by every client",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=0.1,
+            help="Seconds between the messages of a client",
+        )
+        parser.add_argument(
+            "--heartbeat-interval", type=float, default=1.0
+        )
+        parser.add_argument(
+            "--drain-timeout",
+            type=float,
+            default=10.0,
+            help="Seconds to wait for messages still in flight",
+        )
+        parser.add_argument(
+            "--fake-redis",
+            action="store_true",
+            help="Use fakeredis instead of REDIS_URL",
+        )
+        parser.add_argument(
+            "--use-redis-url",
+            action="store_true",
+            help=(
+                "Run against REDIS_URL, whose presence keys the live "
+                "notify streams read"
+            ),
+        )
+        parser.add_argument("--output", type=str, default=None)
+
+    def fake_redis_factory(self):
+        try:
+            import fakeredis
+            import fakeredis.aioredis
+        except ImportError:
+            raise CommandError("--fake-redis needs the fakeredis package")
+
+        server = fakeredis.FakeServer()
+        return lambda: fakeredis.aioredis.create_redis_pool(server=server)
+
+    def create_data(self, options):
+        employees_group, _ = Group.objects.get_or_create(name="Employees")
+        clients = []
+        for i in range(options["clients"]):
+            user = models.User.objects.create_user(
+                "client-%d@%s" % (i, EMAIL_DOMAIN), "loadtest"
+            )
+            order = models.Order.objects.create(
+                user=user,
+                billing_name="Load test",
+                shipping_name="Load test",
+            )
+            clients.append((user, order))
+
+        employees = []
+        for i in range(options["employees"]):
+            user = models.User.objects.create_user(
+                "employee-%d@%s" % (i, EMAIL_DOMAIN),
+                "loadtest",
+                is_staff=True,
+            )
+            user.groups.add(employees_group)
+            employees.append(user)
+        return clients, employees
+
+    def delete_data(self):
+        # Orders and chat messages go with their users
+        models.User.objects.filter(
+            email__endswith="@" + EMAIL_DOMAIN
+        ).delete()
+
+    async def check_redis(self):
+        r_conn = await redis_pool.get()
+        try:
+            key = chat_history.stream_key("loadtest-probe")
+            await r_conn.xadd(key, {"probe": "1"})
+            await r_conn.delete(key)
+        except Exception as e:
+            raise CommandError(
+                "The Redis server does not support the streams used by "
+                "the chat history (%s)" % e
+            )
+
+    async def connect(self, consumer, path, user, order_id=None):
+        communicator = WebsocketCommunicator(consumer, path)
+        communicator.scope["user"] = user
+        if order_id is not None:
+            communicator.scope["url_route"] = {
+                "kwargs": {"order_id": order_id}
+            }
+        connected, _ = await communicator.connect()
+        if not connected:
+            raise CommandError("Could not connect to %s" % path)
+        return communicator
+
+    async def read(self, communicator, stats):
+        while True:
+            data = json.loads(await communicator.receive_from(3600))
+            if isinstance(data, list):
+                stats["presence_pushes"] += 1
+            elif data.get("type") == "chat_message" and data[
+                "message"
+            ].startswith(MESSAGE_PREFIX):
+                sent = float(data["message"][len(MESSAGE_PREFIX):])
+                stats["latencies"].append(time.perf_counter() - sent)
+
+    async def heartbeat(self, communicator, interval):
+        while True:
+            await communicator.send_json_to({"type": "heartbeat"})
+            await asyncio.sleep(interval)
+
+    async def chat(self, communicator, options):
+        for _ in range(options["messages"]):
+            await communicator.send_json_to(
+                {
+                    "type": "message",
+                    "message": MESSAGE_PREFIX + repr(time.perf_counter()),
+                }
+            )
+            await asyncio.sleep(options["interval"])
+
+    async def run(self, options):
+        await self.check_redis()
+        clients, employees = await database_sync_to_async(
+            self.create_data
+        )(options)
+
+        chats = []
+        notify_streams = []
+        background = []
+        try:
+            tracing = not tracemalloc.is_tracing()
+            if tracing:
+                tracemalloc.start()
+            baseline = tracemalloc.get_traced_memory()[0]
+
+            room_sizes = []
+            for user, order in clients:
+                chats.append(
+                    await self.connect(
+                        consumers.ChatConsumer,
+                        "/ws/customer-service/%d/" % order.id,
+                        user,
+                        order.id,
+                    )
+                )
+                room_sizes.append(1)
+            client_chats = list(chats)
+            for i, user in enumerate(employees):
+                notify_streams.append(
+                    await self.connect(
+                        consumers.ChatNotifyConsumer,
+                        "/ws/customer-service/notify/",
+                        user,
+                    )
+                )
+                # Every employee follows an equal share of the chats
+                for j in range(i, len(clients), len(employees)):
+                    order = clients[j][1]
+                    chats.append(
+                        await self.connect(
+                            consumers.ChatConsumer,
+                            "/ws/customer-service/%d/" % order.id,
+                            user,
+                            order.id,
+                        )
+                    )
+                    room_sizes[j] += 1
+
+            connections = len(chats) + len(notify_streams)
+            memory = tracemalloc.get_traced_memory()[0] - baseline
+            if tracing:
+                tracemalloc.stop()
+
+            stats = {"latencies": [], "presence_pushes": 0}
+            background = [
+                asyncio.ensure_future(self.read(c, stats))
+                for c in chats + notify_streams
+            ] + [
+                asyncio.ensure_future(
+                    self.heartbeat(c, options["heartbeat_interval"])
+                )
+                for c in chats
+            ]
+
+            expected = options["messages"] * sum(room_sizes)
+            started = time.perf_counter()
+            await asyncio.gather(
+                *[self.chat(c, options) for c in client_chats]
+            )
+            sent = time.perf_counter() - started
+            deadline = time.perf_counter() + options["drain_timeout"]
+            while (
+                len(stats["latencies"]) < expected
+                and time.perf_counter() < deadline
+            ):
+                await asyncio.sleep(0.05)
+            elapsed = time.perf_counter() - started
+        finally:
+            if tracemalloc.is_tracing() and tracing:
+                tracemalloc.stop()
+            for task in background:
+                task.cancel()
+            await asyncio.gather(*background, return_exceptions=True)
+            for communicator in chats + notify_streams:
+                await communicator.disconnect()
+            await presence.heartbeats.flush()
+            await chat_history.writer.flush()
+            r_conn = await redis_pool.get()
+            for _, order in clients:
+                await r_conn.delete(chat_history.stream_key(order.id))
+            # The pool outlives the chats; it must not outlive the factory
+            await redis_pool.close()
+            await database_sync_to_async(self.delete_data)()
+
+        latencies = sorted(stats["latencies"])
+        messages = options["messages"] * len(clients)
+        return {
+            "clients": len(clients),
+            "employees": len(employees),
+            "connections": connections,
+            "messages": messages,
+            "deliveries": len(latencies),
+            "deliveries_expected": expected,
+            "seconds": round(elapsed, 3),
+            "messages_per_second": round(messages / sent, 1),
+            "deliveries_per_second": round(len(latencies) / elapsed, 1),
+            "latency_ms": {
+                name: round(value * 1000, 2) if value is not None else None
+                for name, value in (
+                    ("p50", percentile(latencies, 50)),
+                    ("p90", percentile(latencies, 90)),
+                    ("p99", percentile(latencies, 99)),
+                    ("max", latencies[-1] if latencies else None),
+                )
+            },
+            "presence_pushes": stats["presence_pushes"],
+            "memory_per_connection_kb": round(
+                memory / max(connections, 1) / 1024, 1
+            ),
+        }
+
+    def handle(self, *args, **options):
+        if options["clients"] < 1:
+            raise CommandError("--clients must be at least 1")
+        if options["fake_redis"] == options["use_redis_url"]:
+            raise CommandError(
+                "Pass either --fake-redis or --use-redis-url"
+            )
+
+        old_factory = redis_pool.factory
+        if options["fake_redis"]:
+            redis_pool.factory = self.fake_redis_factory()
+        # Everything runs in this process, so does the channel layer
+        old_layer = channel_layers.set(
+            DEFAULT_CHANNEL_LAYER, InMemoryChannelLayer()
+        )
+        try:
+            # Chat streams are kept apart from those of real chats
+            with override_settings(CHAT_HISTORY_KEY_PREFIX=CHAT_KEY_PREFIX):
+                report = asyncio.get_event_loop().run_until_complete(
+                    self.run(options)
+                )
+        finally:
+            redis_pool.factory = old_factory
+            if old_layer is None:
+                channel_layers.backends.pop(DEFAULT_CHANNEL_LAYER, None)
+            else:
+                channel_layers.set(DEFAULT_CHANNEL_LAYER, old_layer)
+
+        report["redis"] = (
+            "fakeredis" if options["fake_redis"] else settings.REDIS_URL
+        )
+        report = json.dumps(report, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(report)
+        else:
+            self.stdout.write(report)
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+from main import dispatch
+
+
+class Command(BaseCommand):
+    help = "Group PAID orders into dispatch waves by destination"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--capacity", type=int, default=dispatch.WAVE_CAPACITY
+        )
+        parser.add_argument(
+            "--prefix-length",
+            type=int,
+            default=dispatch.ZIP_PREFIX_LENGTH,
+        )
+
+    def handle(self, *args, **options):
+        waves = dispatch.plan_waves(
+            capacity=options["capacity"],
+            prefix_length=options["prefix_length"],
+        )
+        for wave in waves:
+            self.stdout.write(
+                "%s: %d orders" % (wave, wave.orders.count())
+            )
+        self.stdout.write("Waves created=%d" % len(waves))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+from main import models
+
+
+class Command(BaseCommand):
+    help = "Rebuild the daily sales rollup used by the admin reports"
+
+    def handle(self, *args, **options):
+        self.stdout.write("Rebuilding daily sales rollup")
+        rows = models.DailySales.objects.rebuild()
+        self.stdout.write("Rollup rows written=%d" % rows)
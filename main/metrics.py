@@ -0,0 +1,98 @@
+"""
+In-process metrics.
+
+Counters and summaries live in a per-process registry and are exposed in
+the Prometheus text format by MetricsConsumer.
+"""
+import threading
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self):
+        return [(self.name + '_total', self.value)]
+
+
+class Gauge:
+    kind = 'gauge'
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self):
+        return [(self.name, self.value)]
+
+
+class Summary:
+    """ Count and sum of observed values """
+    kind = 'summary'
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self.count = 0
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        with self.lock:
+            self.count += 1
+            self.sum += value
+
+    def samples(self):
+        return [
+            (self.name + '_count', self.count),
+            (self.name + '_sum', self.sum),
+        ]
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def get(self, cls, name, documentation):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, documentation)
+            return metric
+
+    def counter(self, name, documentation=''):
+        return self.get(Counter, name, documentation)
+
+    def gauge(self, name, documentation=''):
+        return self.get(Gauge, name, documentation)
+
+    def summary(self, name, documentation=''):
+        return self.get(Summary, name, documentation)
+
+    def render(self):
+        lines = []
+        for name in sorted(self.metrics):
+            metric = self.metrics[name]
+            if metric.documentation:
+                lines.append('# HELP %s %s' % (name, metric.documentation))
+            lines.append('# TYPE %s %s' % (name, metric.kind))
+            for sample, value in metric.samples():
+                lines.append('%s %s' % (sample, value))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
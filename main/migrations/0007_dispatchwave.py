@@ -0,0 +1,28 @@
+# Generated by Django 2.2.28 on 2026-10-19 19:30
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0006_dailysales'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DispatchWave',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('country', models.CharField(max_length=3)),
+                ('zip_prefixes', models.CharField(max_length=255)),
+                ('date_added', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='dispatch_wave',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='orders', to='main.DispatchWave'),
+        ),
+    ]
@@ -0,0 +1,40 @@
+from django.db import migrations
+
+# Django compiles icontains on PostgreSQL to
+# UPPER("column"::text) LIKE UPPER(%s), so the indexes are built on the
+# same expression for the planner to use them.
+TRIGRAM_COLUMNS = ('email', 'first_name', 'last_name')
+
+
+def create_trigram_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for column in TRIGRAM_COLUMNS:
+        schema_editor.execute(
+            'CREATE INDEX IF NOT EXISTS main_user_%s_trgm '
+            'ON main_user USING gin (UPPER(%s::text) gin_trgm_ops)'
+            % (column, column)
+        )
+
+
+def drop_trigram_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for column in TRIGRAM_COLUMNS:
+        schema_editor.execute(
+            'DROP INDEX IF EXISTS main_user_%s_trgm' % column
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0007_dispatchwave'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            create_trigram_indexes, drop_trigram_indexes
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 2.2.28 on 2026-10-19 19:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0008_user_trigram_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['status', 'date_added'], name='main_order_status_5fbc0d_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['date_updated'], name='main_order_date_up_8d774c_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['-date_added', '-id'], name='main_order_date_ad_a5b479_idx'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 2.2.28 on 2026-10-19 19:35
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0009_order_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChatMessage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('username', models.CharField(max_length=150)),
+                ('message', models.TextField()),
+                ('stream_id', models.CharField(max_length=32)),
+                ('date_added', models.DateTimeField()),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chat_messages', to='main.Order')),
+                ('user', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='chatmessage',
+            index=models.Index(fields=['order', '-date_added', '-id'], name='main_chatme_order_i_2fd1ab_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='chatmessage',
+            unique_together={('order', 'stream_id')},
+        ),
+    ]
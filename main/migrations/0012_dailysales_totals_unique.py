@@ -0,0 +1,36 @@
+# Generated by Django 2.2.28 on 2026-10-19 19:57
+
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def remove_duplicate_totals(apps, schema_editor):
+    # Concurrent refreshes could insert several totals rows per bucket;
+    # rebuild_sales_rollup recomputes the ones left
+    DailySales = apps.get_model('main', 'DailySales')
+    keep = (
+        DailySales.objects.filter(product__isnull=True)
+        .values('day', 'country')
+        .annotate(keep=Max('id'))
+        .values_list('keep', flat=True)
+    )
+    DailySales.objects.filter(product__isnull=True).exclude(
+        id__in=list(keep)
+    ).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0011_chatmessage_search'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            remove_duplicate_totals, migrations.RunPython.noop
+        ),
+        migrations.AddConstraint(
+            model_name='dailysales',
+            constraint=models.UniqueConstraint(condition=models.Q(product__isnull=True), fields=('day', 'country'), name='main_dailysales_totals_unique'),
+        ),
+    ]
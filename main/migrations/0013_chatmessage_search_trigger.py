@@ -0,0 +1,40 @@
+from django.db import migrations
+
+# search_vector is filled by PostgreSQL's built-in tsvector_update_trigger
+# on every write, bulk inserts included; existing rows are filled once.
+
+
+def create_search_trigger(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(
+        'CREATE TRIGGER main_chatmessage_search_vector '
+        'BEFORE INSERT OR UPDATE OF message ON main_chatmessage '
+        'FOR EACH ROW EXECUTE PROCEDURE tsvector_update_trigger('
+        'search_vector, \'pg_catalog.english\', message)'
+    )
+    schema_editor.execute(
+        'UPDATE main_chatmessage '
+        'SET search_vector = to_tsvector(\'pg_catalog.english\', message) '
+        'WHERE search_vector IS NULL'
+    )
+
+
+def drop_search_trigger(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(
+        'DROP TRIGGER IF EXISTS main_chatmessage_search_vector '
+        'ON main_chatmessage'
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0012_dailysales_totals_unique'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_trigger, drop_search_trigger),
+    ]
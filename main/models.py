@@ -1,12 +1,18 @@
-from django.db import models
+from datetime import datetime, time, timedelta
+from django.db import DatabaseError, connection, models, transaction
 from django.contrib.auth.models import (
     AbstractUser,
     BaseUserManager,
 )
+from django.contrib.postgres.search import SearchVectorField
 from django.core.validators import MinValueValidator
 import logging
 from . import exceptions
+from booktime.auth import forget_tokens
+from rest_framework.authtoken.models import Token
 from django.db.models import Count, Sum
+from django.db.models.functions import TruncDay
+from django.utils import timezone
 
 logger = logging.getLogger(__name__)
 
@@ -23,7 +29,22 @@ class ProductTagManager(models.Manager):
         return self.get(slug=slug)
 
 
-class UserManager(BaseUserManager):
+class UserQuerySet(models.QuerySet):
+    def update(self, **kwargs):
+        # Saves drop the cached token users in a signal, updates send none
+        keys = []
+        if set(kwargs) != {'last_login'}:
+            keys = list(
+                Token.objects.filter(user__in=self).values_list(
+                    'key', flat=True
+                )
+            )
+        rows = super().update(**kwargs)
+        forget_tokens(*keys)
+        return rows
+
+
+class UserManager(BaseUserManager.from_queryset(UserQuerySet)):
     use_in_migrations = True
 
     def _create_user(self, email, password, **extra_fields):
@@ -178,6 +199,7 @@ class Basket(models.Model):
     def count(self):
         return sum(i.quantity for i in self.basketline_set.all())
 
+    @transaction.atomic
     def create_order(self, billing_address, shipping_address):
         if not self.user:
             raise exceptions.BasketException(
@@ -242,6 +264,59 @@ class Basketline(models.Model):
     )
 
 
+class DispatchWave(models.Model):
+    """ A capacity-bounded batch of orders shipped to one country """
+    country = models.CharField(max_length=3)
+    zip_prefixes = models.CharField(max_length=255)
+    date_added = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return 'Wave %d (%s %s)' % (
+            self.id,
+            self.country,
+            self.zip_prefixes,
+        )
+
+
+class OrderManager(models.Manager):
+    def dispatch_lines(self, orders, status):
+        """
+        Moves the lines of the PAID orders among orders to status.
+
+        Everything happens in one transaction: lines are updated with a
+        single UPDATE (CANCELLED lines and lines already past status are
+        left alone), then the orders whose lines are all processed are
+        marked as done with another one; orders without lines stay
+        PAID. Neither touches DailySales, which counts cancelled lines
+        out but ignores other statuses. Returns the number of updated
+        lines.
+        """
+        with transaction.atomic():
+            order_ids = list(
+                orders.filter(status=Order.PAID)
+                .select_for_update()
+                .values_list('id', flat=True)
+            )
+            updated = OrderLine.objects.filter(
+                order_id__in=order_ids, status__lt=status
+            ).update(status=status)
+
+            done = (
+                self.filter(pk__in=order_ids, lines__isnull=False)
+                .exclude(lines__status__lt=OrderLine.SENT)
+                .update(status=Order.DONE, date_updated=timezone.now())
+            )
+
+        logger.info(
+            'Dispatched %d lines of %d orders as status=%d, %d done',
+            updated,
+            len(order_ids),
+            status,
+            done,
+        )
+        return updated
+
+
 class Order(models.Model):
     NEW = 10
     PAID = 20
@@ -276,6 +351,36 @@ class Order(models.Model):
         on_delete=models.SET_NULL,
     )
 
+    dispatch_wave = models.ForeignKey(
+        DispatchWave,
+        null=True,
+        blank=True,
+        related_name='orders',
+        on_delete=models.SET_NULL,
+    )
+
+    objects = OrderManager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'date_added']),
+            models.Index(fields=['date_updated']),
+            models.Index(fields=['-date_added', '-id']),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        if {'date_added', 'shipping_country'} <= set(field_names):
+            # Saves that keep the bucket do not touch the sales rollup
+            instance._loaded_sales_bucket = instance.sales_bucket
+        return instance
+
+    @property
+    def sales_bucket(self):
+        """ The (day, shipping country) DailySales bucket of the order """
+        return order_day(self.date_added), self.shipping_country
+
     @property
     def mobile_thumb_url(self):
         products = [i.product for i in self.lines.all()]
@@ -325,3 +430,320 @@ class OrderLine(models.Model):
         Product, on_delete=models.PROTECT
     )
     status = models.IntegerField(choices=STATUSES, default=NEW)
+
+
+def order_day(date):
+    """ Returns the (local) day an order timestamp falls on """
+    if timezone.is_naive(date):
+        date = timezone.make_aware(date)
+    return timezone.localdate(date)
+
+
+def sales_bucket_lock_key(day, country):
+    """ A stable advisory lock key for a (day, country) rollup bucket """
+    return day.toordinal() << 24 | int.from_bytes(
+        country.encode()[:3].ljust(3, b'\0'), 'big'
+    )
+
+
+class SalesBuckets:
+    """
+    The rollup buckets changed by a transaction, refreshed once when it
+    commits. It is the on_commit callback itself, so it is discarded
+    along with the transaction or savepoint that registered it.
+    """
+
+    def __init__(self, manager):
+        self.manager = manager
+        # (day, country) -> product ids to refresh, None for all of them
+        self.buckets = {}
+
+    def add(self, day, country, product_ids=None):
+        key = (day, country)
+        if key not in self.buckets:
+            self.buckets[key] = (
+                None if product_ids is None else set(product_ids)
+            )
+        elif product_ids is None:
+            self.buckets[key] = None
+        elif self.buckets[key] is not None:
+            self.buckets[key].update(product_ids)
+
+    def __call__(self):
+        while self.buckets:
+            (day, country), product_ids = self.buckets.popitem()
+            try:
+                self.manager.refresh(day, country, product_ids)
+            except DatabaseError:
+                # The order is committed already; rebuild_sales_rollup
+                # repairs the rollup
+                logger.exception(
+                    'Refreshing daily sales of %s %s failed', day, country
+                )
+
+
+class DailySalesManager(models.Manager):
+    def scheduled(self):
+        """
+        The buckets of the current transaction, if any. Savepoints get
+        their own, so that rolling one back drops only its buckets.
+        """
+        connection = transaction.get_connection()
+        savepoint_ids = set(connection.savepoint_ids)
+        for sids, callback in connection.run_on_commit:
+            if isinstance(callback, SalesBuckets) and sids == savepoint_ids:
+                return callback
+        return None
+
+    def schedule(self, day, country, product_ids=None):
+        """
+        Refreshes a bucket once the current transaction commits.
+
+        A bucket scheduled several times in a transaction (an order and
+        each of its lines) is refreshed once, outside of the transaction
+        that changed it. Outside of a transaction, it is refreshed now.
+        """
+        buckets = self.scheduled()
+        if buckets is None:
+            buckets = SalesBuckets(self)
+            buckets.add(day, country, product_ids)
+            transaction.on_commit(buckets)
+        else:
+            buckets.add(day, country, product_ids)
+
+    def refresh_scheduled(self):
+        """ Refreshes the buckets of the current transaction now """
+        buckets = self.scheduled()
+        if buckets is not None:
+            buckets()
+
+    def refresh(self, day, country, product_ids=None):
+        """
+        Recomputes the rollup rows of a single day and shipping country.
+
+        Only rows of product_ids (plus the per-day totals row) are
+        recomputed when given, so saving an order line touches one
+        product bucket instead of the whole day. Refreshes of the same
+        bucket are serialized with an advisory lock on PostgreSQL and
+        rows are upserted, so concurrent checkouts cannot collide.
+        """
+        with transaction.atomic():
+            if connection.vendor == 'postgresql':
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        'SELECT pg_advisory_xact_lock(%s)',
+                        [sales_bucket_lock_key(day, country)],
+                    )
+            self.write_bucket(day, country, product_ids)
+
+    def write_bucket(self, day, country, product_ids):
+        start = timezone.make_aware(datetime.combine(day, time.min))
+        orders = Order.objects.filter(
+            date_added__gte=start,
+            date_added__lt=start + timedelta(days=1),
+            shipping_country=country,
+        )
+        all_lines = OrderLine.objects.filter(
+            order__in=orders
+        ).exclude(status=OrderLine.CANCELLED)
+        lines = all_lines
+        stale = self.filter(day=day, country=country)
+        if product_ids is not None:
+            lines = lines.filter(product_id__in=product_ids)
+            stale = stale.filter(
+                models.Q(product_id__in=product_ids)
+                | models.Q(product__isnull=True)
+            )
+
+        rows = [
+            (
+                line['product'],
+                line['orders'],
+                line['units'],
+                line['revenue'],
+            )
+            for line in lines.values('product').annotate(
+                orders=Count('order', distinct=True),
+                units=Count('id'),
+                revenue=Sum('product__price'),
+            )
+        ]
+        self.upsert(day, country, rows)
+
+        totals = all_lines.aggregate(
+            units=Count('id'), revenue=Sum('product__price')
+        )
+        order_count = orders.count()
+        if order_count:
+            self.upsert(
+                day,
+                country,
+                [
+                    (
+                        None,
+                        order_count,
+                        totals['units'],
+                        totals['revenue'] or 0,
+                    )
+                ],
+            )
+
+        # Products left without lines, and the totals of a day that has
+        # no orders anymore
+        stale.filter(product__isnull=False).exclude(
+            product_id__in=[row[0] for row in rows]
+        ).delete()
+        if not order_count:
+            stale.filter(product__isnull=True).delete()
+
+    def upsert(self, day, country, rows):
+        """
+        Inserts or updates rollup rows given as
+        (product id, orders, units, revenue) tuples
+        """
+        if not rows:
+            return
+        if rows[0][0] is None:
+            target = '(day, country) WHERE product_id IS NULL'
+        else:
+            target = '(day, country, product_id)'
+        sql = (
+            'INSERT INTO %s (day, country, product_id, orders, units, '
+            'revenue) VALUES %s ON CONFLICT %s DO UPDATE SET '
+            'orders = EXCLUDED.orders, units = EXCLUDED.units, '
+            'revenue = EXCLUDED.revenue'
+            % (
+                self.model._meta.db_table,
+                ', '.join(['(%s, %s, %s, %s, %s, %s)'] * len(rows)),
+                target,
+            )
+        )
+        params = []
+        for product_id, orders, units, revenue in rows:
+            params += [day, country, product_id, orders, units, revenue]
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+
+    def rebuild(self):
+        """ Recomputes the whole rollup table from orders """
+        lines = (
+            OrderLine.objects.exclude(status=OrderLine.CANCELLED)
+            .annotate(day=TruncDay('order__date_added'))
+            .values('day', 'order__shipping_country', 'product')
+            .annotate(
+                orders=Count('order', distinct=True),
+                units=Count('id'),
+                revenue=Sum('product__price'),
+            )
+            .order_by()
+        )
+        totals = {}
+        rows = []
+        for line in lines.iterator():
+            day = line['day'].date()
+            country = line['order__shipping_country']
+            rows.append(
+                self.model(
+                    day=day,
+                    country=country,
+                    product_id=line['product'],
+                    orders=line['orders'],
+                    units=line['units'],
+                    revenue=line['revenue'],
+                )
+            )
+            units, revenue = totals.get((day, country), (0, 0))
+            totals[day, country] = (
+                units + line['units'],
+                revenue + line['revenue'],
+            )
+
+        order_counts = (
+            Order.objects.annotate(day=TruncDay('date_added'))
+            .values('day', 'shipping_country')
+            .annotate(c=Count('id'))
+            .order_by()
+        )
+        for order_count in order_counts.iterator():
+            day = order_count['day'].date()
+            country = order_count['shipping_country']
+            units, revenue = totals.get((day, country), (0, 0))
+            rows.append(
+                self.model(
+                    day=day,
+                    country=country,
+                    product=None,
+                    orders=order_count['c'],
+                    units=units,
+                    revenue=revenue,
+                )
+            )
+
+        with transaction.atomic():
+            self.all().delete()
+            self.bulk_create(rows, batch_size=1000)
+        return len(rows)
+
+
+class DailySales(models.Model):
+    """
+    Pre-aggregated sales per day, product and shipping country.
+
+    Rows with an empty product hold the totals of the day, so
+    orders without lines are still counted once; a partial unique
+    index keeps a single totals row per day and country, as NULL
+    products are not unique otherwise.
+
+    Order lines do not store their price, so revenue is computed with
+    the current product prices and changes when a price does.
+    """
+    day = models.DateField()
+    country = models.CharField(max_length=3)
+    product = models.ForeignKey(
+        Product, null=True, on_delete=models.CASCADE
+    )
+    orders = models.PositiveIntegerField(default=0)
+    units = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(
+        max_digits=12, decimal_places=2, default=0
+    )
+
+    objects = DailySalesManager()
+
+    class Meta:
+        unique_together = ('day', 'country', 'product')
+        indexes = [models.Index(fields=['day', 'product'])]
+        constraints = [
+            models.UniqueConstraint(
+                fields=['day', 'country'],
+                condition=models.Q(product__isnull=True),
+                name='main_dailysales_totals_unique',
+            )
+        ]
+
+
+class ChatMessage(models.Model):
+    """
+    A customer service chat message.
+
+    Messages are first appended to the Redis stream of their order and
+    written here in batches, stream_id being the id of the stream entry.
+    search_vector is filled by a trigger on PostgreSQL.
+    """
+    order = models.ForeignKey(
+        Order, on_delete=models.CASCADE, related_name='chat_messages'
+    )
+    user = models.ForeignKey(
+        User, null=True, on_delete=models.SET_NULL
+    )
+    username = models.CharField(max_length=150)
+    message = models.TextField()
+    stream_id = models.CharField(max_length=32)
+    date_added = models.DateTimeField()
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    class Meta:
+        unique_together = ('order', 'stream_id')
+        indexes = [
+            models.Index(fields=['order', '-date_added', '-id']),
+        ]
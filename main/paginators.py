@@ -0,0 +1,27 @@
+"""
+Keyset pagination helpers.
+
+Pages ordered by ('-date_added', '-id') are continued with an ?after=
+cursor holding the date and id of the last row shown, so that deep
+pages cost no OFFSET.
+"""
+from django.utils.dateparse import parse_datetime
+
+
+def parse_cursor(params):
+    """ Returns the (date_added, id) cursor of params, or None """
+    try:
+        date_added, pk = params['after'].rsplit(',', 1)
+        date_added = parse_datetime(date_added)
+    except (KeyError, ValueError):
+        return None
+    if date_added is None or not pk.isdigit():
+        return None
+    return date_added, int(pk)
+
+
+def next_page_query(params, date_added, pk):
+    """ Returns params as a query string continuing after date_added, pk """
+    params = params.copy()
+    params['after'] = '%s,%d' % (date_added.isoformat(), pk)
+    return params.urlencode()
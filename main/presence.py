@@ -0,0 +1,327 @@
+"""
+Chat presence kept in Redis sorted sets.
+
+Every order with someone in its chat has a sorted set of
+"<status>:<email>" members scored with their expiry timestamp, and
+the orders themselves are indexed in another sorted set scored with
+their latest expiry. Expired entries are simply ignored by readers, so
+presence needs no KEYS scan and no per-key TTL bookkeeping.
+"""
+import asyncio
+import json
+import logging
+import time
+import uuid
+from collections import defaultdict
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.urls import reverse
+
+from .metrics import registry
+from .redis_pool import redis_pool
+
+logger = logging.getLogger(__name__)
+
+PRESENCE_TTL = 10
+# Seconds before a failed broadcaster is restarted, doubled up to the max
+RESTART_DELAY = 0.5
+MAX_RESTART_DELAY = 30
+PRESENCE_GROUP = 'customer-service-presence'
+ORDERS_KEY = 'customer-service:presence'
+
+heartbeats_received = registry.counter(
+    'presence_heartbeats', 'Chat heartbeats received'
+)
+heartbeat_flushes = registry.counter(
+    'presence_heartbeat_flushes', 'Heartbeat batches written to Redis'
+)
+heartbeat_flush_errors = registry.counter(
+    'presence_heartbeat_flush_errors', 'Heartbeat batches that failed'
+)
+heartbeat_batch_size = registry.summary(
+    'presence_heartbeat_batch_size', 'Heartbeats per written batch'
+)
+heartbeat_flush_seconds = registry.summary(
+    'presence_heartbeat_flush_seconds', 'Duration of batch writes'
+)
+heartbeat_latency_seconds = registry.summary(
+    'presence_heartbeat_latency_seconds',
+    'Delay between receiving a heartbeat and writing it',
+)
+
+
+def order_key(order_id):
+    return 'customer-service:presence:%s' % order_id
+
+
+def member(email, status):
+    return '%s:%s' % (status, email)
+
+
+async def write_heartbeats(r_conn, heartbeats, now=None):
+    """
+    Writes {(order_id, member): expires} heartbeats with one pipelined
+    call; returns how many members were not present yet, which is the
+    only case where listeners need to be told about it.
+    """
+    now = now or time.time()
+    orders = defaultdict(dict)
+    for (order_id, name), expires in heartbeats.items():
+        orders[order_id][name] = expires
+
+    pipe = r_conn.pipeline()
+    added = []
+    for order_id, members in orders.items():
+        key = order_key(order_id)
+        # Expired members are dropped so that coming back counts as new
+        pipe.zremrangebyscore(key, max=now)
+        for name, expires in members.items():
+            added.append(pipe.zadd(key, expires, name))
+        expires = max(members.values())
+        pipe.expireat(key, int(expires) + 1)
+        pipe.zadd(ORDERS_KEY, expires, str(order_id))
+    await pipe.execute()
+    return sum([await a for a in added])
+
+
+async def snapshot(r_conn, now=None):
+    """
+    Returns the presence payload sent to the notify streams and the
+    timestamp of the next expiry (None when nobody is present).
+    """
+    now = now or time.time()
+    await r_conn.zremrangebyscore(ORDERS_KEY, max=now)
+    order_ids = await r_conn.zrangebyscore(ORDERS_KEY, min=now)
+
+    pipe = r_conn.pipeline()
+    members = [
+        pipe.zrangebyscore(order_key(o.decode()), min=now, withscores=True)
+        for o in order_ids
+    ]
+    await pipe.execute()
+
+    payload = []
+    next_expiry = None
+    for order_id, entries in zip(order_ids, members):
+        order_id = order_id.decode()
+        emails = []
+        chat_status = None
+        for member, expires in await entries:
+            status, email = member.decode().split(':', 1)
+            emails.append(email)
+            # If there already is an operator - do not change the state of chat
+            if chat_status != 'Operator':
+                chat_status = status
+            if next_expiry is None or expires < next_expiry:
+                next_expiry = expires
+        if not emails:
+            continue
+
+        payload.append(
+            {
+                'link': reverse(
+                    'cs_chat', kwargs={'order_id': order_id}
+                ),
+                'text': '%s (%s)' % (order_id, ', '.join(emails)),
+                'status': chat_status,
+            }
+        )
+    payload.sort(key=lambda p: p['link'])
+    return payload, next_expiry
+
+
+class PresenceBroadcaster:
+    """
+    Computes the presence payload once per change for a whole process.
+
+    A single task listens to PRESENCE_GROUP, rebuilds the payload when
+    presence changes or an entry expires, serializes it once and fans
+    it out to the notify streams of this process through a
+    process-local group. It runs while at least one stream is
+    subscribed, and is restarted with a growing delay when it fails.
+    """
+
+    def __init__(self):
+        self.group = None
+        self.subscribers = 0
+        self.task = None
+        self.text = None
+        self.loop = None
+        self.restart_delay = RESTART_DELAY
+
+    async def subscribe(self, channel_name):
+        """ Adds a notify stream; returns the last payload, if any """
+        layer = get_channel_layer()
+        loop = asyncio.get_event_loop()
+        if self.loop is not loop:
+            self.loop = loop
+            # Named in the worker: processes forked from a preloaded
+            # parent would share a name derived from its pid
+            self.group = 'customer-service-notify.%s' % uuid.uuid4().hex
+            self.subscribers = 0
+            self.task = None
+            self.text = None
+            self.restart_delay = RESTART_DELAY
+
+        await layer.group_add(self.group, channel_name)
+        self.subscribers += 1
+        if self.task is None or self.task.done():
+            self.start()
+        return self.text
+
+    def start(self):
+        logger.info('Starting presence broadcaster')
+        self.task = asyncio.ensure_future(self.run())
+        self.task.add_done_callback(self.stopped)
+
+    def stopped(self, task):
+        if task is not self.task:
+            return
+        self.task = None
+        if task.cancelled():
+            return
+        logger.error(
+            'Presence broadcaster failed, restarting in %.1fs',
+            self.restart_delay,
+            exc_info=task.exception(),
+        )
+        self.loop.call_later(self.restart_delay, self.resume)
+        self.restart_delay = min(self.restart_delay * 2, MAX_RESTART_DELAY)
+
+    def resume(self):
+        if self.subscribers and self.task is None:
+            self.start()
+
+    async def unsubscribe(self, channel_name):
+        await get_channel_layer().group_discard(self.group, channel_name)
+        self.subscribers = max(self.subscribers - 1, 0)
+        if self.subscribers == 0 and self.task is not None:
+            logger.info('Stopping presence broadcaster')
+            self.task.cancel()
+            self.task = None
+            self.text = None
+
+    async def stop(self):
+        """ Stops the task for good, e.g. on shutdown """
+        task, self.task = self.task, None
+        self.subscribers = 0
+        if task is not None:
+            logger.info('Stopping presence broadcaster')
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    async def run(self):
+        layer = get_channel_layer()
+        channel = await layer.new_channel()
+        await layer.group_add(PRESENCE_GROUP, channel)
+        r_conn = await redis_pool.get()
+        try:
+            # The first payload includes heartbeats not written yet
+            await heartbeats.flush()
+            while True:
+                payload, next_expiry = await snapshot(r_conn)
+                text = json.dumps(payload)
+                if text != self.text:
+                    self.text = text
+                    await layer.group_send(
+                        self.group,
+                        {'type': 'presence_broadcast', 'text': text},
+                    )
+                self.restart_delay = RESTART_DELAY
+
+                timeout = None
+                if next_expiry is not None:
+                    timeout = max(next_expiry - time.time(), 0) + 0.1
+                try:
+                    await asyncio.wait_for(layer.receive(channel), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            await layer.group_discard(PRESENCE_GROUP, channel)
+
+
+broadcaster = PresenceBroadcaster()
+
+
+class HeartbeatBatcher:
+    """
+    Collects the chat heartbeats of a process and writes them with a
+    single pipelined call every PRESENCE_FLUSH_INTERVAL seconds.
+
+    Expiry is computed when a heartbeat is received, so batching delays
+    the write but not the expiry. Listeners are told once per batch
+    when somebody joined.
+    """
+
+    def __init__(self):
+        self.pending = {}
+        self.task = None
+        self.loop = None
+
+    def add(self, order_id, email, status, now=None):
+        loop = asyncio.get_event_loop()
+        if self.loop is not loop:
+            self.loop = loop
+            self.pending = {}
+            self.task = None
+
+        expires = (now or time.time()) + PRESENCE_TTL
+        self.pending[(order_id, member(email, status))] = expires
+        heartbeats_received.inc()
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+
+    async def run(self):
+        try:
+            while self.pending:
+                await asyncio.sleep(
+                    getattr(settings, 'PRESENCE_FLUSH_INTERVAL', 0.5)
+                )
+                await self.flush()
+        finally:
+            self.task = None
+
+    async def stop(self):
+        """ Stops the task and writes what is pending, e.g. on shutdown """
+        task, self.task = self.task, None
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        await self.flush()
+
+    async def flush(self):
+        batch, self.pending = self.pending, {}
+        if not batch:
+            return
+
+        started = time.time()
+        r_conn = await redis_pool.get()
+        try:
+            joined = await write_heartbeats(r_conn, batch, started)
+        except asyncio.CancelledError:
+            # Left to the next flush, unless newer heartbeats came in
+            for key, expires in batch.items():
+                self.pending.setdefault(key, expires)
+            raise
+        except Exception:
+            heartbeat_flush_errors.inc()
+            logger.exception('Could not write %d heartbeats', len(batch))
+            return
+
+        finished = time.time()
+        heartbeat_flushes.inc()
+        heartbeat_batch_size.observe(len(batch))
+        heartbeat_flush_seconds.observe(finished - started)
+        for expires in batch.values():
+            heartbeat_latency_seconds.observe(
+                finished - (expires - PRESENCE_TTL)
+            )
+
+        if joined:
+            await get_channel_layer().group_send(
+                PRESENCE_GROUP, {'type': 'presence_changed'}
+            )
+
+
+heartbeats = HeartbeatBatcher()
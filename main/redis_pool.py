@@ -0,0 +1,82 @@
+import asyncio
+import logging
+import types
+
+import aioredis
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+def close_with_loop(loop, pool):
+    """
+    Makes loop close pool before closing itself, as channels_redis does
+    with its connections, so that the pool of an event loop that is
+    not used anymore does not leak its connections.
+    """
+    close = loop.close
+
+    def wrapper(self, *args, **kwargs):
+        if not self.is_closed() and not pool.closed:
+            pool.close()
+            self.run_until_complete(pool.wait_closed())
+        self.close = close
+        return close(*args, **kwargs)
+
+    loop.close = types.MethodType(wrapper, loop)
+
+
+class RedisPool:
+    """
+    Process-wide aioredis pool shared by all consumers.
+
+    The pool is opened on first use and kept for the life of the
+    process, so connections are not churned as chats come and go; it
+    is closed on ASGI lifespan shutdown, see main.lifespan, or when
+    its event loop is closed. factory, when set, is a coroutine
+    function used instead of create_pool, e.g. to run against a Redis
+    stand-in.
+    """
+
+    def __init__(self):
+        self.factory = None
+        self.pool = None
+        self.loop = None
+        self.lock = None
+
+    def get_lock(self):
+        loop = asyncio.get_event_loop()
+        if self.lock is None or self.loop is not loop:
+            # Pools and locks belong to the loop they were created in;
+            # the previous pool is closed along with its loop
+            self.lock = asyncio.Lock()
+            self.loop = loop
+            self.pool = None
+        return self.lock
+
+    async def get(self):
+        async with self.get_lock():
+            if self.pool is None or self.pool.closed:
+                self.pool = await (self.factory or self.create_pool)()
+                close_with_loop(self.loop, self.pool)
+            return self.pool
+
+    async def create_pool(self):
+        logger.info('Opening Redis pool to %s', settings.REDIS_URL)
+        return await aioredis.create_redis_pool(
+            settings.REDIS_URL,
+            minsize=settings.REDIS_POOL_MINSIZE,
+            maxsize=settings.REDIS_POOL_MAXSIZE,
+        )
+
+    async def close(self):
+        """ Closes the pool, e.g. on shutdown """
+        async with self.get_lock():
+            if self.pool is not None:
+                logger.info('Closing Redis pool')
+                self.pool.close()
+                await self.pool.wait_closed()
+                self.pool = None
+
+
+redis_pool = RedisPool()
@@ -1,4 +1,5 @@
 from django.urls import path
+from channels.auth import AuthMiddlewareStack
 from booktime.auth import TokenGetAuthMiddlewareStack
 from . import consumers
 
@@ -14,8 +15,16 @@ websocket_urlpatterns = [
 ]
 
 http_urlpatterns = [
+    path(
+        "mobile-api/my-orders/tracker/",
+        TokenGetAuthMiddlewareStack(consumers.BatchOrderTrackerConsumer),
+    ),
     path(
         "mobile-api/my-orders/<int:order_id>/tracker/",
         TokenGetAuthMiddlewareStack(consumers.OrderTrackerConsumer),
-    )
+    ),
+    path(
+        "metrics/",
+        AuthMiddlewareStack(consumers.MetricsConsumer),
+    ),
 ]
@@ -2,12 +2,15 @@ from io import BytesIO
 import logging
 from PIL import Image
 from django.core.files.base import ContentFile
-from django.db.models.signals import pre_save, post_save
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.dispatch import receiver
-from .models import ProductImage, Basket, OrderLine, Order
+from .models import (
+    ProductImage, Basket, OrderLine, Order, DailySales
+)
 from django.contrib.auth.signals import user_logged_in
 from django.conf import settings
 from rest_framework.authtoken.models import Token
+from booktime.auth import forget_tokens
 
 THUMBNAIL_SIZE = (300, 300)
 
@@ -69,9 +72,58 @@ def orderline_to_order_status(sender, instance, **kwargs):
         instance.order.save()
 
 
+@receiver(post_save, sender=OrderLine)
+@receiver(post_delete, sender=OrderLine)
+def orderline_to_daily_sales(sender, instance, **kwargs):
+    try:
+        order = instance.order
+    except Order.DoesNotExist:
+        return
+    DailySales.objects.schedule(
+        *order.sales_bucket, product_ids=[instance.product_id]
+    )
+
+
+@receiver(post_save, sender=Order)
+def order_to_daily_sales(sender, instance, created=False, **kwargs):
+    bucket = instance.sales_bucket
+    loaded = getattr(instance, '_loaded_sales_bucket', None)
+    if created:
+        # A new order has no lines yet, only the totals change
+        DailySales.objects.schedule(*bucket, product_ids=[])
+    elif loaded != bucket:
+        if loaded is not None:
+            DailySales.objects.schedule(*loaded)
+        DailySales.objects.schedule(*bucket)
+    instance._loaded_sales_bucket = bucket
+
+
+@receiver(post_delete, sender=Order)
+def deleted_order_to_daily_sales(sender, instance, **kwargs):
+    DailySales.objects.schedule(*instance.sales_bucket)
+
+
 @receiver(post_save, sender=settings.AUTH_USER_MODEL)
 def create_auth_token(
         sender, instance=None, created=False, **kwargs
 ):
     if created:
-        Token.objects.create(user=instance)
\ No newline at end of file
+        Token.objects.create(user=instance)
+
+
+@receiver(post_delete, sender=Token)
+def token_to_cache(sender, instance, **kwargs):
+    forget_tokens(instance.key)
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def user_to_token_cache(
+        sender, instance, created=False, update_fields=None, **kwargs
+):
+    # Logins only touch last_login, which cached users need not reflect
+    if not created and update_fields != frozenset(['last_login']):
+        forget_tokens(
+            *Token.objects.filter(user=instance).values_list(
+                'key', flat=True
+            )
+        )
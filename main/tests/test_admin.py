@@ -1,10 +1,20 @@
-from django.test import TestCase
+import os
+import threading
+import time
+import zipfile
+from io import BytesIO
+import tempfile
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
 from django.urls import reverse
+from django.utils.timezone import utc
 from main import factories
-from main import models
+from main import admin, dispatch, invoices, models
 from datetime import datetime
 from decimal import Decimal
+from unittest import skipUnless
 from unittest.mock import patch
+from pypdf import PdfReader
 
 
 class TestAdminView(TestCase):
@@ -33,6 +43,8 @@ class TestAdminView(TestCase):
         factories.OrderLineFactory.create_batch(
             1, order=orders[2], product=products[1]
         )
+        # The rollup is refreshed on commit, which TestCase never does
+        models.DailySales.objects.refresh_scheduled()
         user = models.User.objects.create_superuser(
             'user2', 'topsecret'
         )
@@ -53,6 +65,16 @@ class TestAdminView(TestCase):
 
         self.assertEqual(data, {'B': 3, 'C': 2, 'A': 6})
 
+        response = self.client.get(
+            reverse('admin:most_bought_products_export'),
+            {'period': '90', 'format': 'csv'},
+        )
+        self.assertEqual(response.status_code, 200)
+        rows = b''.join(response.streaming_content).decode().split()
+        self.assertEqual(
+            rows, ['product__name,c', 'A,6', 'B,3', 'C,2']
+        )
+
     def test_invoice_renders_exactly_as_expected(self):
         products = [
             factories.ProductFactory(
@@ -107,3 +129,477 @@ class TestAdminView(TestCase):
                 expected_content = fixture.read()
 
             self.assertHTMLEqual(content, expected_content)
+
+    def test_invoice_pdf_is_rendered_once_and_cached(self):
+        product = factories.ProductFactory(
+            name='Siddhartha', price=Decimal('9.00')
+        )
+        order = factories.OrderFactory()
+        factories.OrderLineFactory(order=order, product=product)
+        user = models.User.objects.create_superuser(
+            'user3', 'topsecret'
+        )
+        self.client.force_login(user)
+        url = reverse('admin:invoice', kwargs={'order_id': order.id})
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            with override_settings(INVOICE_CACHE_DIR=cache_dir), patch(
+                'main.invoices.HTML', wraps=invoices.HTML
+            ) as html:
+                for _ in range(2):
+                    response = self.client.get(url, {'format': 'pdf'})
+                    self.assertEqual(response.status_code, 200)
+                    self.assertEqual(
+                        response['Content-Type'], 'application/pdf'
+                    )
+                    self.assertTrue(
+                        b''.join(response.streaming_content)
+                    )
+
+            self.assertEqual(html.call_count, 1)
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+    def test_invoice_renders_only_remove_older_versions(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            older, newer, newest = (
+                os.path.join(cache_dir, '7-2019010100000%d000000.pdf' % i)
+                for i in range(3)
+            )
+            invoices.write_pdf('<p>1</p>', newer)
+            # A slow render of an older version finishing late
+            invoices.write_pdf('<p>0</p>', older)
+            self.assertEqual(
+                sorted(os.listdir(cache_dir)),
+                [os.path.basename(older), os.path.basename(newer)],
+            )
+            invoices.write_pdf('<p>2</p>', newest)
+            self.assertEqual(
+                os.listdir(cache_dir), [os.path.basename(newest)]
+            )
+
+    def test_download_invoices_action_streams_zip(self):
+        orders = factories.OrderFactory.create_batch(2)
+        user = models.User.objects.create_superuser(
+            'user4', 'topsecret'
+        )
+        self.client.force_login(user)
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            with override_settings(INVOICE_CACHE_DIR=cache_dir):
+                response = self.client.post(
+                    reverse('admin:main_order_changelist'),
+                    {
+                        'action': 'download_invoices',
+                        '_selected_action': [o.id for o in orders],
+                    },
+                )
+                content = b''.join(response.streaming_content)
+
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        archive = zipfile.ZipFile(BytesIO(content))
+        self.assertEqual(
+            archive.namelist(),
+            ['invoice-BT%d.pdf' % o.id for o in orders],
+        )
+
+    def test_download_merged_invoice_action_appends_every_invoice(self):
+        orders = factories.OrderFactory.create_batch(2)
+        user = models.User.objects.create_superuser(
+            'user5', 'topsecret'
+        )
+        self.client.force_login(user)
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            with override_settings(INVOICE_CACHE_DIR=cache_dir):
+                response = self.client.post(
+                    reverse('admin:main_order_changelist'),
+                    {
+                        'action': 'download_merged_invoice',
+                        '_selected_action': [o.id for o in orders],
+                    },
+                )
+                content = b''.join(response.streaming_content)
+
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        self.assertEqual(len(PdfReader(BytesIO(content)).pages), 2)
+
+
+class TestMergedInvoiceInBackground(TransactionTestCase):
+    def test_large_merges_are_polled_until_written(self):
+        orders = factories.OrderFactory.create_batch(3)
+        user = models.User.objects.create_superuser(
+            'user6', 'topsecret'
+        )
+        self.client.force_login(user)
+        release = threading.Event()
+        write_merged_pdf = invoices.write_merged_pdf
+
+        def blocked_write(*args, **kwargs):
+            release.wait(10)
+            return write_merged_pdf(*args, **kwargs)
+
+        with tempfile.TemporaryDirectory() as cache_dir, override_settings(
+            INVOICE_CACHE_DIR=cache_dir, INVOICE_MERGE_SYNC_LIMIT=2
+        ), patch('main.invoices.write_merged_pdf', blocked_write):
+            response = self.client.post(
+                reverse('admin:main_order_changelist'),
+                {
+                    'action': 'download_merged_invoice',
+                    '_selected_action': [o.id for o in orders],
+                },
+            )
+            self.assertEqual(response.status_code, 302)
+            url = response['Location']
+
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 202)
+            self.assertEqual(response['Retry-After'], '5')
+
+            release.set()
+            path = os.path.join(
+                cache_dir, 'merged', url.rstrip('/').split('/')[-1] + '.pdf'
+            )
+            # Pending for every process while the part file is written
+            self.assertTrue(os.path.exists(path + '.part'))
+            for _ in range(100):
+                if not invoices.is_pending(path):
+                    break
+                time.sleep(0.1)
+
+            for _ in range(2):
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                content = b''.join(response.streaming_content)
+                self.assertEqual(
+                    len(PdfReader(BytesIO(content)).pages), 3
+                )
+            self.assertFalse(os.path.exists(path + '.part'))
+
+
+class TestAdminQueryCounts(TestCase):
+    # Queries per changelist page, independent of the number of rows;
+    # measured on PostgreSQL, SQLite runs the same number
+    EXPECTED_QUERIES = {
+        'admin': {
+            'product': 5,
+            'producttag': 5,
+            'productimage': 5,
+            'user': 6,
+            'address': 5,
+            'basket': 4,
+            'order': 5,
+        },
+        'central-office-admin': {
+            'product': 5,
+            'producttag': 5,
+            'productimage': 5,
+            'address': 5,
+            'order': 5,
+        },
+        'dispatchers-admin': {
+            'product': 5,
+            'producttag': 5,
+            'order': 5,
+        },
+    }
+
+    def create_rows(self, count):
+        for i in range(count):
+            user = factories.UserFactory(
+                email='customer%d@site.com' % i
+            )
+            product = factories.ProductFactory(
+                name='Book %d' % i, slug='book-%d' % i
+            )
+            product.tags.create(name='Tag %d' % i, slug='tag-%d' % i)
+            models.ProductImage.objects.bulk_create(
+                [
+                    models.ProductImage(
+                        product=product,
+                        image='book.jpg',
+                        thumbnail='book.thumb.jpg',
+                    )
+                ]
+            )
+            factories.AddressFactory(
+                user=user,
+                name='Home',
+                address1='Street',
+                zip_code='00-001',
+                city='Warsaw',
+                country='pl',
+            )
+            basket = models.Basket.objects.create(user=user)
+            models.Basketline.objects.create(
+                basket=basket, product=product, quantity=2
+            )
+            order = factories.OrderFactory(
+                user=user, status=models.Order.PAID
+            )
+            factories.OrderLineFactory(order=order, product=product)
+
+    def test_changelist_query_counts_are_pinned(self):
+        self.create_rows(5)
+        user = models.User.objects.create_superuser(
+            'owner@site.com', 'topsecret'
+        )
+        self.client.force_login(user)
+
+        for site in (
+            admin.main_admin,
+            admin.central_office_admin,
+            admin.dispatchers_admin,
+        ):
+            expected = self.EXPECTED_QUERIES[site.name]
+            self.assertEqual(
+                set(expected),
+                {m._meta.model_name for m in site._registry},
+            )
+            for model in site._registry:
+                name = model._meta.model_name
+                url = reverse(
+                    '%s:main_%s_changelist' % (site.name, name)
+                )
+                with self.subTest(site=site.name, model=name):
+                    with self.assertNumQueries(expected[name]):
+                        response = self.client.get(url)
+                    self.assertEqual(response.status_code, 200)
+
+    @skipUnless(connection.vendor == 'postgresql', 'Needs PostgreSQL')
+    def test_approximate_count_takes_a_single_query(self):
+        factories.ProductFactory.create_batch(3)
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE main_product')
+        factories.ProductFactory.create_batch(2)
+        products = models.Product.objects.all()
+
+        # Above threshold the estimate wins, below it the exact count
+        for threshold, expected in ((1, 3), (1000, 5)):
+            paginator = admin.ApproximateCountPaginator(products, 10)
+            paginator.threshold = threshold
+            with self.assertNumQueries(1):
+                self.assertEqual(paginator.count, expected)
+
+
+class TestPickList(TestCase):
+    def test_pick_list_aggregates_open_lines_by_product(self):
+        a = factories.ProductFactory(name='A')
+        b = factories.ProductFactory(name='B')
+        paid = factories.OrderFactory.create_batch(
+            2, status=models.Order.PAID
+        )
+        unpaid = factories.OrderFactory(status=models.Order.NEW)
+        factories.OrderLineFactory.create_batch(
+            2, order=paid[0], product=a
+        )
+        factories.OrderLineFactory(order=paid[1], product=a)
+        factories.OrderLineFactory(order=paid[1], product=b)
+        factories.OrderLineFactory(
+            order=paid[1], product=b, status=models.OrderLine.SENT
+        )
+        factories.OrderLineFactory(order=unpaid, product=b)
+
+        with self.assertNumQueries(1):
+            pages = list(dispatch.pick_list_pages(page_size=1))
+
+        self.assertEqual(
+            pages,
+            [
+                [
+                    {
+                        'id': a.id,
+                        'name': 'A',
+                        'quantity': 3,
+                        'orders': [(paid[0].id, 2), (paid[1].id, 1)],
+                    }
+                ],
+                [
+                    {
+                        'id': b.id,
+                        'name': 'B',
+                        'quantity': 1,
+                        'orders': [(paid[1].id, 1)],
+                    }
+                ],
+            ],
+        )
+
+        user = models.User.objects.create_superuser(
+            'dispatch@site.com', 'topsecret'
+        )
+        self.client.force_login(user)
+        response = self.client.get(reverse('dispatchers-admin:pick_list'))
+        content = b''.join(response.streaming_content).decode()
+        self.assertIn('BT%d &times; 2' % paid[0].id, content)
+
+
+class TestDispatchWaves(TestCase):
+    def test_waves_are_bounded_and_single_country(self):
+        orders = [
+            (1, 'pl', '00-950'),
+            (2, 'uk', 'SW1A 1AA'),
+            (3, 'pl', '00-001'),
+            (4, 'pl', '31-000'),
+            (5, 'uk', 'SW19 5AE'),
+            (6, 'pl', '01-100'),
+        ]
+        self.assertEqual(
+            dispatch.group_waves(orders, capacity=2),
+            [
+                ('pl', ['00'], [1, 3]),
+                ('pl', ['01', '31'], [6, 4]),
+                ('uk', ['SW'], [2, 5]),
+            ],
+        )
+
+    def test_plan_waves_assigns_paid_orders(self):
+        paid = factories.OrderFactory.create_batch(
+            3,
+            status=models.Order.PAID,
+            shipping_country='pl',
+            shipping_zip_code='00-950',
+        )
+        unpaid = factories.OrderFactory(status=models.Order.NEW)
+
+        waves = dispatch.plan_waves(capacity=2)
+
+        self.assertEqual(len(waves), 2)
+        self.assertEqual(
+            [w.orders.count() for w in waves], [2, 1]
+        )
+        unpaid.refresh_from_db()
+        self.assertIsNone(unpaid.dispatch_wave)
+        self.assertEqual(dispatch.plan_waves(capacity=2), [])
+        self.assertEqual(
+            models.Order.objects.filter(
+                dispatch_wave__isnull=False
+            ).count(),
+            len(paid),
+        )
+
+    def test_dispatcher_orders_are_filtered_by_wave(self):
+        planned, unplanned = factories.OrderFactory.create_batch(
+            2, status=models.Order.PAID, shipping_country='pl'
+        )
+        wave = models.DispatchWave.objects.create(
+            country='pl', zip_prefixes='00'
+        )
+        models.Order.objects.filter(pk=planned.pk).update(
+            dispatch_wave=wave
+        )
+        user = models.User.objects.create_superuser(
+            'dispatcher@site.com', 'topsecret'
+        )
+        self.client.force_login(user)
+        url = reverse('dispatchers-admin:main_order_changelist')
+
+        for query, order in (
+            ('?planned=no', unplanned),
+            ('?planned=yes', planned),
+            ('?dispatch_wave__id__exact=%d' % wave.id, planned),
+        ):
+            with self.subTest(query=query):
+                response = self.client.get(url + query)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(
+                    list(response.context['cl'].result_list), [order]
+                )
+
+    def test_dispatch_waves_page_redirects_after_planning(self):
+        factories.OrderFactory.create_batch(
+            3, status=models.Order.PAID, shipping_country='pl'
+        )
+        user = models.User.objects.create_superuser(
+            'dispatcher@site.com', 'topsecret'
+        )
+        self.client.force_login(user)
+        url = reverse('dispatchers-admin:dispatch_waves')
+
+        response = self.client.post(
+            url, {'capacity': 2, 'prefix_length': 2}
+        )
+        self.assertRedirects(
+            response, url, fetch_redirect_response=False
+        )
+
+        response = self.client.get(url)
+        self.assertContains(response, '2 dispatch waves planned')
+        self.assertEqual(models.DispatchWave.objects.count(), 2)
+
+
+class TestChatSearch(TestCase):
+    def create_messages(self):
+        customer = factories.UserFactory(email='lost@site.com')
+        order = factories.OrderFactory(user=customer)
+        other = factories.OrderFactory()
+        texts = [
+            (order, 'Where is my parcel?'),
+            (order, 'The parcel left the warehouse'),
+            (order, 'Thanks!'),
+            (other, 'Is the parcel insured?'),
+        ]
+        models.ChatMessage.objects.bulk_create(
+            [
+                models.ChatMessage(
+                    order=o,
+                    username='Someone',
+                    message=text,
+                    stream_id='%d-0' % i,
+                    date_added=datetime(2019, 1, 1, 10, i, tzinfo=utc),
+                )
+                for i, (o, text) in enumerate(texts)
+            ]
+        )
+        return order, other
+
+    def test_chat_search_by_keyword_order_and_email(self):
+        order, other = self.create_messages()
+        if connection.vendor == 'postgresql':
+            # bulk_create runs no Python code, the trigger fills these
+            self.assertFalse(
+                models.ChatMessage.objects.filter(
+                    search_vector__isnull=True
+                ).exists()
+            )
+        user = models.User.objects.create_superuser(
+            'lead@site.com', 'topsecret'
+        )
+        self.client.force_login(user)
+        url = reverse('central-office-admin:chat_search')
+
+        def search(q, **params):
+            response = self.client.get(url, dict(q=q, **params))
+            self.assertEqual(response.status_code, 200)
+            return response
+
+        response = search('parcel')
+        self.assertEqual(
+            [m.message for m in response.context['results']],
+            [
+                'Is the parcel insured?',
+                'The parcel left the warehouse',
+                'Where is my parcel?',
+            ],
+        )
+        self.assertIsNone(response.context['next_query'])
+
+        response = search(str(other.id))
+        self.assertEqual(
+            [m.order_id for m in response.context['results']],
+            [other.id],
+        )
+
+        with override_settings(CHAT_HISTORY_PAGE_SIZE=2):
+            response = search('LOST@site.com')
+            self.assertEqual(
+                [m.message for m in response.context['results']],
+                ['Thanks!', 'The parcel left the warehouse'],
+            )
+            response = self.client.get(
+                url + '?' + response.context['next_query']
+            )
+        self.assertEqual(
+            [m.message for m in response.context['results']],
+            ['Where is my parcel?'],
+        )
+        self.assertIsNone(response.context['next_query'])
@@ -1,15 +1,46 @@
 import asyncio
+import importlib.util
 import json
+import logging
+import os
+import tempfile
+import uuid
+from io import StringIO
+from django.core.management import CommandError, call_command
 from django.contrib.auth.models import Group
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from rest_framework.authtoken.models import Token
+from booktime.auth import TokenGetAuthMiddlewareStack
 from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from asgiref.testing import ApplicationCommunicator
 from channels.testing import WebsocketCommunicator, HttpCommunicator
+from main import chat_history
 from main import consumers
+from main import lifespan
 from main import factories
+from main import log
+from main import exceptions
+from main import models
+from main import tracking
+from unittest import skipUnless
 from unittest.mock import MagicMock, patch
 
 
 class TestConsumers(TestCase):
+    def setUp(self):
+        # Ids are reused between tests, so is the debounce state
+        consumers.ChatConsumer.spoken_to = {}
+        # and so would be the chat streams left by earlier runs
+        streams = override_settings(
+            CHAT_HISTORY_KEY_PREFIX='test:%s:chat:' % uuid.uuid4().hex,
+            CHAT_HISTORY_STREAM_TTL=60,
+        )
+        streams.enable()
+        self.addCleanup(streams.disable)
+
     def test_chat_between_two_users_works(self):
         def init_db():
             user = factories.UserFactory(
@@ -108,6 +139,142 @@ class TestConsumers(TestCase):
         loop = asyncio.get_event_loop()
         loop.run_until_complete(test_body())
 
+    @override_settings(CHAT_HISTORY_REPLAY=2, CHAT_HISTORY_PAGE_SIZE=2)
+    def test_chat_history_is_replayed_and_paged(self):
+        def init_db():
+            user = factories.UserFactory(
+                email='ghost@task.force',
+                first_name='Simon',
+                last_name='Riley',
+            )
+            order = factories.OrderFactory(user=user)
+            return user, order
+
+        async def test_body():
+            user, order = await database_sync_to_async(init_db)()
+
+            def chat():
+                communicator = WebsocketCommunicator(
+                    consumers.ChatConsumer,
+                    f'/ws/customer-service/{order.id}/',
+                )
+                communicator.scope['user'] = user
+                communicator.scope['url_route'] = {
+                    'kwargs': {'order_id': order.id}
+                }
+                return communicator
+
+            communicator = chat()
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            await communicator.receive_json_from()
+            for text in ('one', 'two', 'three'):
+                await communicator.send_json_to(
+                    {'type': 'message', 'message': text}
+                )
+                await communicator.receive_json_from()
+            await communicator.disconnect()
+
+            communicator = chat()
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            replay = await communicator.receive_json_from()
+            self.assertEqual(replay['type'], 'history')
+            self.assertEqual(
+                [m['message'] for m in replay['messages']],
+                ['two', 'three'],
+            )
+            self.assertEqual(
+                (await communicator.receive_json_from())['type'],
+                'chat_join',
+            )
+
+            await communicator.send_json_to(
+                {'type': 'history', 'before': replay['messages'][0]['id']}
+            )
+            page = await communicator.receive_json_from()
+            self.assertEqual(
+                [m['message'] for m in page['messages']], ['one']
+            )
+            self.assertFalse(page['more'])
+
+            for before in (123, 'abc', '1-2-3'):
+                await communicator.send_json_to(
+                    {'type': 'history', 'before': before}
+                )
+                self.assertEqual(
+                    await communicator.receive_json_from(),
+                    {
+                        'type': 'history',
+                        'messages': [],
+                        'more': False,
+                        'error': 'invalid cursor',
+                    },
+                )
+
+            for message in (123, '', 'x' * 2001, None):
+                await communicator.send_json_to(
+                    {'type': 'message', 'message': message}
+                )
+            await communicator.send_json_to({'type': 'history'})
+            self.assertEqual(
+                [
+                    m['message']
+                    for m in (await communicator.receive_json_from())[
+                        'messages'
+                    ]
+                ],
+                ['two', 'three'],
+            )
+            await communicator.disconnect()
+
+            r_conn = await consumers.redis_pool.get()
+            ttl = await r_conn.ttl(chat_history.stream_key(order.id))
+            self.assertTrue(0 < ttl <= 60)
+
+            count = models.ChatMessage.objects.filter(order=order).count
+            # Paging did not write the history, any process's flush does
+            self.assertEqual(await database_sync_to_async(count)(), 0)
+            self.assertFalse(
+                await chat_history.HistoryWriter().flush()
+            )
+            self.assertEqual(await database_sync_to_async(count)(), 3)
+            await chat_history.HistoryWriter().flush()
+            self.assertEqual(await database_sync_to_async(count)(), 3)
+
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(test_body())
+
+    def test_last_spoken_to_is_updated_only_when_it_changes(self):
+        employees, _ = Group.objects.get_or_create(name='Employees')
+        first = factories.UserFactory(
+            email='first@booktime.domain', is_staff=True
+        )
+        second = factories.UserFactory(
+            email='second@booktime.domain', is_staff=True
+        )
+        for employee in (first, second):
+            employee.groups.add(employees)
+        order = factories.OrderFactory()
+        date_updated = order.date_updated
+        consumer = consumers.ChatConsumer(scope={})
+
+        # Order lookup, group check, UPDATE
+        with self.assertNumQueries(3):
+            self.assertEqual(
+                consumer.get_user_type(first, order.id),
+                consumers.ChatConsumer.EMPLOYEE,
+            )
+        # Reconnects are debounced
+        with self.assertNumQueries(2):
+            consumer.get_user_type(first, order.id)
+        with self.assertNumQueries(3):
+            consumer.get_user_type(second, order.id)
+
+        order.refresh_from_db()
+        self.assertEqual(order.last_spoken_to, second)
+        self.assertEqual(order.date_updated, date_updated)
+
     def test_chat_presence_works(self):
         def init_db():
             user = factories.UserFactory(
@@ -167,6 +334,7 @@ class TestConsumers(TestCase):
                     {
                         "link": f"/customer-service/{order.id}/",
                         "text": f"{order.id} (user2@site.com)",
+                        "status": "Customer",
                     }
                 ]
             )
@@ -174,6 +342,248 @@ class TestConsumers(TestCase):
         loop = asyncio.get_event_loop()
         loop.run_until_complete(test_body())
 
+    def test_chat_presence_is_pushed_on_change_only(self):
+        def init_db():
+            user = factories.UserFactory(
+                email="user3@site.com",
+                first_name="Jane",
+                last_name="Doe",
+            )
+            order = factories.OrderFactory(user=user)
+            cs_user = factories.UserFactory(
+                email="customerservice3@booktime.domain",
+                is_staff=True,
+            )
+            employees, _ = Group.objects.get_or_create(
+                name="Employees"
+            )
+            cs_user.groups.add(employees)
+
+            return user, order, cs_user
+
+        async def test_body():
+            user, order, notify_user = await database_sync_to_async(
+                init_db
+            )()
+
+            notify = WebsocketCommunicator(
+                consumers.ChatNotifyConsumer,
+                "ws/customer-service/notify/",
+            )
+            notify.scope["user"] = notify_user
+            connected, _ = await notify.connect()
+            self.assertTrue(connected)
+            initial = await notify.receive_json_from()
+
+            communicator = WebsocketCommunicator(
+                consumers.ChatConsumer,
+                "/ws/customer-service/%d/" % order.id,
+            )
+            communicator.scope["user"] = user
+            communicator.scope["url_route"] = {
+                "kwargs": {"order_id": order.id}
+            }
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+
+            await communicator.send_json_to({"type": "heartbeat"})
+            response = await notify.receive_json_from()
+            self.assertIn(
+                {
+                    "link": f"/customer-service/{order.id}/",
+                    "text": f"{order.id} (user3@site.com)",
+                    "status": "Customer",
+                },
+                response,
+            )
+            self.assertEqual(len(response), len(initial) + 1)
+
+            await communicator.send_json_to({"type": "heartbeat"})
+            self.assertTrue(await notify.receive_nothing(timeout=0.5))
+
+            await communicator.disconnect()
+            await notify.disconnect()
+
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(test_body())
+
+    def test_notify_streams_share_one_presence_broadcaster(self):
+        def init_db():
+            cs_user = factories.UserFactory(
+                email="customerservice4@booktime.domain",
+                is_staff=True,
+            )
+            employees, _ = Group.objects.get_or_create(
+                name="Employees"
+            )
+            cs_user.groups.add(employees)
+            return cs_user
+
+        async def test_body():
+            cs_user = await database_sync_to_async(init_db)()
+            broadcaster = consumers.presence.broadcaster
+
+            first = WebsocketCommunicator(
+                consumers.ChatNotifyConsumer,
+                "ws/customer-service/notify/",
+            )
+            first.scope["user"] = cs_user
+            connected, _ = await first.connect()
+            self.assertTrue(connected)
+            first_payload = await first.receive_from()
+            task = broadcaster.task
+
+            second = WebsocketCommunicator(
+                consumers.ChatNotifyConsumer,
+                "ws/customer-service/notify/",
+            )
+            second.scope["user"] = cs_user
+            connected, _ = await second.connect()
+            self.assertTrue(connected)
+            self.assertEqual(await second.receive_from(), first_payload)
+            self.assertIs(broadcaster.task, task)
+            self.assertEqual(broadcaster.subscribers, 2)
+
+            await first.disconnect()
+            self.assertIs(broadcaster.task, task)
+            await second.disconnect()
+            self.assertIsNone(broadcaster.task)
+            self.assertEqual(broadcaster.subscribers, 0)
+
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(test_body())
+
+    def test_failed_presence_broadcaster_is_restarted(self):
+        broadcaster = consumers.presence.PresenceBroadcaster()
+        snapshot = consumers.presence.snapshot
+        calls = []
+
+        async def failing_snapshot(r_conn, now=None):
+            calls.append(now)
+            if len(calls) == 1:
+                raise ConnectionError('Redis went away')
+            return await snapshot(r_conn, now)
+
+        async def test_body():
+            layer = get_channel_layer()
+            channel = await layer.new_channel()
+            with patch.object(
+                consumers.presence, 'snapshot', failing_snapshot
+            ), self.assertLogs('main.presence', 'ERROR'):
+                await broadcaster.subscribe(channel)
+                message = await asyncio.wait_for(
+                    layer.receive(channel), 5
+                )
+            self.assertEqual(message['type'], 'presence_broadcast')
+            self.assertEqual(len(calls), 2)
+            self.assertFalse(broadcaster.task.done())
+            await broadcaster.unsubscribe(channel)
+
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(test_body())
+
+    def test_presence_groups_are_named_in_each_worker(self):
+        # Created before any worker runs, like the module singleton of
+        # workers forked from a preloaded parent
+        workers = [
+            consumers.presence.PresenceBroadcaster() for _ in range(2)
+        ]
+
+        async def test_body():
+            layer = get_channel_layer()
+            channels = []
+            for broadcaster in workers:
+                self.assertIsNone(broadcaster.group)
+                channels.append(await layer.new_channel())
+                await broadcaster.subscribe(channels[-1])
+            groups = [broadcaster.group for broadcaster in workers]
+            for broadcaster, channel in zip(workers, channels):
+                await broadcaster.unsubscribe(channel)
+            return groups
+
+        loop = asyncio.get_event_loop()
+        first, second = loop.run_until_complete(test_body())
+        self.assertNotEqual(first, second)
+
+    @override_settings(PRESENCE_FLUSH_INTERVAL=0.1)
+    def test_heartbeats_are_written_in_batches(self):
+        def init_db():
+            orders = []
+            for i in range(2):
+                user = factories.UserFactory(email="batch%d@site.com" % i)
+                orders.append(factories.OrderFactory(user=user))
+            return orders
+
+        async def test_body():
+            orders = await database_sync_to_async(init_db)()
+            flushes = consumers.presence.heartbeat_flushes.value
+            received = consumers.presence.heartbeats_received.value
+            batches = consumers.presence.heartbeat_batch_size.sum
+
+            communicators = []
+            for order in orders:
+                communicator = WebsocketCommunicator(
+                    consumers.ChatConsumer,
+                    "/ws/customer-service/%d/" % order.id,
+                )
+                communicator.scope["user"] = order.user
+                communicator.scope["url_route"] = {
+                    "kwargs": {"order_id": order.id}
+                }
+                connected, _ = await communicator.connect()
+                self.assertTrue(connected)
+                communicators.append(communicator)
+
+            for _ in range(3):
+                for communicator in communicators:
+                    await communicator.send_json_to({"type": "heartbeat"})
+            await asyncio.sleep(0.5)
+
+            self.assertEqual(
+                consumers.presence.heartbeat_flushes.value - flushes, 1
+            )
+            self.assertEqual(
+                consumers.presence.heartbeats_received.value - received, 6
+            )
+            # Repeated heartbeats of a chat are coalesced
+            self.assertEqual(
+                consumers.presence.heartbeat_batch_size.sum - batches, 2
+            )
+
+            r_conn = await consumers.redis_pool.get()
+            payload, _ = await consumers.presence.snapshot(r_conn)
+            texts = {p["text"] for p in payload}
+            for i, order in enumerate(orders):
+                self.assertIn("%d (batch%d@site.com)" % (order.id, i), texts)
+
+            for communicator in communicators:
+                await communicator.disconnect()
+
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(test_body())
+
+    def test_metrics_are_served_to_staff_only(self):
+        customer = factories.UserFactory(email="metrics@site.com")
+        staff = factories.UserFactory(
+            email="metrics@booktime.domain", is_staff=True
+        )
+
+        async def test_body():
+            responses = []
+            for user in (customer, staff):
+                communicator = HttpCommunicator(
+                    consumers.MetricsConsumer, "GET", "/metrics/"
+                )
+                communicator.scope["user"] = user
+                responses.append(await communicator.get_response())
+            return responses
+
+        loop = asyncio.get_event_loop()
+        forbidden, response = loop.run_until_complete(test_body())
+        self.assertEqual(forbidden["status"], 403)
+        self.assertEqual(response["status"], 200)
+        self.assertIn(b"presence_heartbeats_total", response["body"])
+
     def test_order_tracker_works(self):
         def init_db():
             user = factories.UserFactory(
@@ -214,4 +624,371 @@ class TestConsumers(TestCase):
                 )
 
         loop = asyncio.get_event_loop()
-        loop.run_until_complete(test_body())
\ No newline at end of file
+        loop.run_until_complete(test_body())
+
+    def test_order_tracking_is_cached_and_coalesced(self):
+        calls = []
+
+        async def track(request):
+            order_id = request.match_info['order_id']
+            calls.append(order_id)
+            await asyncio.sleep(0.1)
+            return web.Response(body=b'SHIPPED ' + order_id.encode())
+
+        async def test_body():
+            app = web.Application()
+            app.router.add_get('/track/{order_id}', track)
+            server = TestServer(app)
+            await server.start_server()
+            url = str(server.make_url('/track/')) + '{order_id}'
+            client = tracking.TrackingClient()
+            try:
+                with override_settings(ORDER_TRACKER_URL=url):
+                    payloads = await asyncio.gather(
+                        *[client.get(1) for _ in range(5)]
+                    )
+                    self.assertEqual(payloads, [(b'SHIPPED 1', None)] * 5)
+                    self.assertEqual(calls, ['1'])
+
+                    self.assertEqual(
+                        await client.get(1), (b'SHIPPED 1', None)
+                    )
+                    self.assertEqual(calls, ['1'])
+                    self.assertEqual(
+                        await client.get(2), (b'SHIPPED 2', None)
+                    )
+                    self.assertEqual(calls, ['1', '2'])
+            finally:
+                await client.close()
+                await server.close()
+
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(test_body())
+
+    @override_settings(
+        ORDER_TRACKER_CACHE_TTL=0.05,
+        ORDER_TRACKER_FAILURE_THRESHOLD=2,
+        ORDER_TRACKER_RESET_TIMEOUT=60,
+        ORDER_TRACKER_STALE_TIMEOUT=0.2,
+    )
+    def test_order_tracking_breaker_serves_stale_payloads(self):
+        upstream = {'calls': 0, 'status': 200, 'delay': 0}
+
+        async def track(request):
+            upstream['calls'] += 1
+            await asyncio.sleep(upstream['delay'])
+            return web.Response(
+                status=upstream['status'],
+                body=b'SHIPPED %d' % upstream['calls'],
+            )
+
+        async def test_body():
+            app = web.Application()
+            app.router.add_get('/track/{order_id}', track)
+            server = TestServer(app)
+            await server.start_server()
+            url = str(server.make_url('/track/')) + '{order_id}'
+            client = tracking.TrackingClient()
+            try:
+                with override_settings(ORDER_TRACKER_URL=url):
+                    self.assertEqual(
+                        await client.get(1), (b'SHIPPED 1', None)
+                    )
+                    await asyncio.sleep(0.1)
+
+                    # Slow upstream: stale now, refreshed in background
+                    upstream['delay'] = 0.4
+                    payload, age = await client.get(1)
+                    self.assertEqual(payload, b'SHIPPED 1')
+                    self.assertGreater(age, 0.05)
+                    await asyncio.sleep(0.4)
+                    self.assertEqual(client.cache[1][0], b'SHIPPED 2')
+                    upstream['delay'] = 0
+
+                    # Failing upstream opens the circuit
+                    upstream['status'] = 500
+                    await asyncio.sleep(0.1)
+                    for _ in range(2):
+                        payload, age = await client.get(1)
+                        self.assertEqual(payload, b'SHIPPED 2')
+                        self.assertIsNotNone(age)
+                    self.assertEqual(
+                        client.breaker.state, client.breaker.OPEN
+                    )
+                    calls = upstream['calls']
+                    payload, age = await client.get(1)
+                    self.assertEqual(payload, b'SHIPPED 2')
+                    self.assertEqual(upstream['calls'], calls)
+                    with self.assertRaises(exceptions.TrackingUnavailable):
+                        await client.get(2)
+
+                    # A successful trial closes it again
+                    upstream['status'] = 200
+                    client.breaker.opened_at -= 60
+                    payload, age = await client.get(1)
+                    self.assertIsNone(age)
+                    self.assertEqual(
+                        client.breaker.state, client.breaker.CLOSED
+                    )
+                    self.assertEqual(tracking.circuit_open.value, 0)
+            finally:
+                await client.close()
+                await server.close()
+
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(test_body())
+
+    @override_settings(
+        ORDER_TRACKER_FAILURE_THRESHOLD=1,
+        ORDER_TRACKER_RESET_TIMEOUT=60,
+    )
+    def test_order_tracking_trial_fails_on_unexpected_errors(self):
+        async def test_body():
+            client = tracking.TrackingClient()
+            client.breaker.failure()
+            client.breaker.opened_at -= 60
+            try:
+                with patch.object(
+                    client, 'url', side_effect=ValueError('Bad URL')
+                ):
+                    with self.assertRaises(ValueError):
+                        await client.get(1)
+                self.assertFalse(client.breaker.trial)
+                self.assertEqual(client.breaker.state, client.breaker.OPEN)
+            finally:
+                await client.close()
+
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(test_body())
+
+    def test_order_tracker_flags_stale_payloads(self):
+        def init_db():
+            user = factories.UserFactory(email='stale@site.com')
+            order = factories.OrderFactory(user=user)
+            return user, order
+
+        async def stale_get(order_id):
+            return b'SHIPPED', 42.0
+
+        async def test_body():
+            user, order = await database_sync_to_async(init_db)()
+            with patch.object(tracking.client, 'get', stale_get):
+                communicator = HttpCommunicator(
+                    consumers.OrderTrackerConsumer,
+                    'GET',
+                    f'/mobile-api/my-orders/{order.id}/tracker/',
+                )
+                communicator.scope['user'] = user
+                communicator.scope['url_route'] = {
+                    'kwargs': {'order_id': order.id}
+                }
+                return await communicator.get_response()
+
+        loop = asyncio.get_event_loop()
+        response = loop.run_until_complete(test_body())
+        self.assertEqual(response['status'], 200)
+        self.assertEqual(response['body'], b'SHIPPED')
+        self.assertIn((b'X-Tracking-Age', b'42'), response['headers'])
+
+    @override_settings(ORDER_TRACKER_BATCH_CONCURRENCY=2)
+    def test_batch_order_tracker_streams_owned_orders(self):
+        def init_db():
+            user = factories.UserFactory(email='batchtracker@site.com')
+            orders = factories.OrderFactory.create_batch(3, user=user)
+            other = factories.OrderFactory(
+                user=factories.UserFactory(email='other@site.com')
+            )
+            return user, orders, other
+
+        running = {'now': 0, 'max': 0}
+
+        async def fake_get(order_id):
+            running['now'] += 1
+            running['max'] = max(running['max'], running['now'])
+            await asyncio.sleep(0.05)
+            running['now'] -= 1
+            return b'SHIPPED %d' % order_id, None
+
+        async def test_body():
+            user, orders, other = await database_sync_to_async(init_db)()
+            ids = [o.id for o in orders] + [other.id]
+            with patch.object(tracking.client, 'get', fake_get):
+                communicator = HttpCommunicator(
+                    consumers.BatchOrderTrackerConsumer,
+                    'GET',
+                    '/mobile-api/my-orders/tracker/',
+                )
+                communicator.scope['user'] = user
+                communicator.scope['query_string'] = (
+                    'ids=%s' % ','.join(map(str, ids))
+                ).encode()
+                response = await communicator.get_response()
+            return response, orders, other
+
+        loop = asyncio.get_event_loop()
+        response, orders, other = loop.run_until_complete(test_body())
+        self.assertEqual(response['status'], 200)
+        lines = [
+            json.loads(line)
+            for line in response['body'].decode().splitlines()
+        ]
+        self.assertEqual(
+            lines[0], {'order_id': other.id, 'error': 'not found'}
+        )
+        self.assertCountEqual(
+            lines[1:],
+            [
+                {
+                    'order_id': o.id,
+                    'tracking': 'SHIPPED %d' % o.id,
+                    'stale_age': None,
+                }
+                for o in orders
+            ],
+        )
+        self.assertEqual(running['max'], 2)
+
+    def test_token_middleware_authenticates_query_token(self):
+        def init_db():
+            staff = factories.UserFactory(
+                email='tokenstaff@booktime.domain', is_staff=True
+            )
+            return Token.objects.get(user=staff).key
+
+        async def test_body():
+            key = await database_sync_to_async(init_db)()
+            responses = []
+            for query in ('', '?token=' + key, '?token=wrong'):
+                communicator = HttpCommunicator(
+                    TokenGetAuthMiddlewareStack(consumers.MetricsConsumer),
+                    'GET',
+                    '/metrics/' + query,
+                )
+                responses.append(await communicator.get_response())
+            return [r['status'] for r in responses]
+
+        loop = asyncio.get_event_loop()
+        self.assertEqual(
+            loop.run_until_complete(test_body()), [403, 200, 403]
+        )
+
+    def test_lifespan_shutdown_releases_resources(self):
+        async def test_body():
+            order = await database_sync_to_async(factories.OrderFactory)()
+            pool = await consumers.redis_pool.get()
+            await chat_history.record(
+                pool, order.id, order.user, 'not written yet'
+            )
+            self.assertFalse(pool.closed)
+            self.assertIs(await consumers.redis_pool.get(), pool)
+
+            session = tracking.client.get_session()
+            await consumers.presence.broadcaster.subscribe('notify-test')
+            broadcaster = consumers.presence.broadcaster.task
+            consumers.presence.heartbeats.add(
+                order.id, order.user.email, 'Customer'
+            )
+            flushes = consumers.presence.heartbeat_flushes.value
+
+            communicator = ApplicationCommunicator(
+                lifespan.Lifespan, {"type": "lifespan"}
+            )
+            await communicator.send_input({"type": "lifespan.startup"})
+            self.assertEqual(
+                await communicator.receive_output(),
+                {"type": "lifespan.startup.complete"},
+            )
+            await communicator.send_input({"type": "lifespan.shutdown"})
+            self.assertEqual(
+                await communicator.receive_output(),
+                {"type": "lifespan.shutdown.complete"},
+            )
+            self.assertTrue(pool.closed)
+            self.assertIsNone(consumers.redis_pool.pool)
+            self.assertTrue(session.closed)
+            self.assertTrue(broadcaster.cancelled())
+            self.assertIsNone(consumers.presence.broadcaster.task)
+            self.assertIsNone(consumers.presence.heartbeats.task)
+            self.assertEqual(consumers.presence.heartbeats.pending, {})
+            self.assertGreater(
+                consumers.presence.heartbeat_flushes.value, flushes
+            )
+            self.assertTrue(
+                await database_sync_to_async(
+                    models.ChatMessage.objects.filter(
+                        order=order, message='not written yet'
+                    ).exists
+                )()
+            )
+
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(test_body())
+
+    def test_redis_pool_is_closed_with_its_loop(self):
+        previous = asyncio.get_event_loop()
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            pool = loop.run_until_complete(consumers.redis_pool.get())
+            self.assertFalse(pool.closed)
+        finally:
+            loop.close()
+            asyncio.set_event_loop(previous)
+        self.assertTrue(pool.closed)
+
+    def test_queue_file_handler_writes_from_a_thread(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'consumers.log')
+            handler = log.QueueFileHandler(filename, maxsize=1)
+            logger = logging.getLogger('main.tests.queue_file_handler')
+            logger.addHandler(handler)
+            try:
+                logger.warning(
+                    'Payload %s', log.truncate(b'x' * 300, limit=5)
+                )
+            finally:
+                logger.removeHandler(handler)
+                handler.close()
+
+            with open(filename) as f:
+                self.assertEqual(
+                    f.read(), 'Payload xxxxx... (300 in total)\n'
+                )
+
+    @skipUnless(
+        importlib.util.find_spec('fakeredis'), 'needs the fakeredis package'
+    )
+    def test_chat_load_test_reports_and_cleans_up(self):
+        out = StringIO()
+        call_command(
+            'loadtest_chat',
+            '--clients', '3',
+            '--employees', '2',
+            '--messages', '2',
+            '--interval', '0',
+            '--heartbeat-interval', '0.05',
+            '--fake-redis',
+            stdout=out,
+        )
+
+        report = json.loads(out.getvalue())
+        # 3 clients in their rooms, plus 3 employee connections
+        self.assertEqual(report['connections'], 3 + 3 + 2)
+        self.assertEqual(report['deliveries'], 2 * (3 + 3))
+        self.assertEqual(
+            report['deliveries'], report['deliveries_expected']
+        )
+        self.assertIsNotNone(report['latency_ms']['p99'])
+        self.assertGreater(report['memory_per_connection_kb'], 0)
+        self.assertFalse(
+            models.User.objects.filter(
+                email__endswith='@loadtest.invalid'
+            ).exists()
+        )
+
+    def test_chat_load_test_needs_an_explicit_redis(self):
+        with self.assertRaisesMessage(
+            CommandError, 'Pass either --fake-redis or --use-redis-url'
+        ):
+            call_command('loadtest_chat', '--clients', '1')
+        self.assertFalse(models.User.objects.exists())
@@ -1,9 +1,15 @@
+import tempfile
+from unittest.mock import patch
+from django.core.cache import caches
+from django.db import DatabaseError
+from django.test import override_settings
 from django.urls import reverse
 from rest_framework.test import APITestCase
 from main import models
 from rest_framework.authtoken.models import Token
 from rest_framework import status
 from main import factories
+from booktime import auth
 
 
 class TestEndpoints(APITestCase):
@@ -62,3 +68,156 @@ class TestEndpoints(APITestCase):
             },
         ]
         self.assertEqual(response.json(), expected)
+
+    def test_dispatch_marks_paid_orders_sent(self):
+        dispatcher = factories.UserFactory(
+            email='dispatch@mail.com', is_superuser=True
+        )
+        product = factories.ProductFactory(name='Book', price=5.00)
+        paid = factories.OrderFactory.create_batch(
+            2, status=models.Order.PAID
+        )
+        new = factories.OrderFactory(status=models.Order.NEW)
+        for order in paid + [new]:
+            factories.OrderLineFactory.create_batch(
+                2, order=order, product=product
+            )
+        empty = factories.OrderFactory(status=models.Order.PAID)
+        self.client.force_authenticate(dispatcher)
+
+        # The whole dispatch is rolled back when a step fails
+        with patch.object(
+            models.OrderManager, 'filter', side_effect=DatabaseError
+        ), self.assertRaises(DatabaseError):
+            models.Order.objects.dispatch_lines(
+                models.Order.objects.all(), models.OrderLine.SENT
+            )
+        self.assertFalse(
+            models.OrderLine.objects.exclude(
+                status=models.OrderLine.NEW
+            ).exists()
+        )
+
+        response = self.client.post(
+            reverse('dispatch_orders'),
+            {
+                'orders': [o.id for o in paid + [new, empty]],
+                'status': 'sent',
+            },
+            format='json',
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json(), {'lines_updated': 4})
+
+        for order in paid:
+            order.refresh_from_db()
+            self.assertEqual(order.status, models.Order.DONE)
+        new.refresh_from_db()
+        self.assertEqual(new.status, models.Order.NEW)
+        empty.refresh_from_db()
+        self.assertEqual(empty.status, models.Order.PAID)
+        self.assertFalse(
+            new.lines.exclude(status=models.OrderLine.NEW).exists()
+        )
+
+        customer = factories.UserFactory(email='nope@mail.com')
+        self.client.force_authenticate(customer)
+        response = self.client.post(
+            reverse('dispatch_orders'),
+            {'orders': [new.id], 'status': 'sent'},
+            format='json',
+        )
+        self.assertEqual(
+            response.status_code, status.HTTP_403_FORBIDDEN
+        )
+
+    def shared_token_cache(self):
+        # Files are seen by every process, unlike local memory
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        return override_settings(
+            CACHES={
+                'default': {
+                    'BACKEND': (
+                        'django.core.cache.backends.locmem.LocMemCache'
+                    ),
+                },
+                'tokens': {
+                    'BACKEND': (
+                        'django.core.cache.backends.filebased.FileBasedCache'
+                    ),
+                    'LOCATION': directory.name,
+                },
+            },
+            TOKEN_CACHE='tokens',
+        )
+
+    def test_token_users_are_cached_until_invalidated(self):
+        with self.shared_token_cache():
+            user = factories.UserFactory(email='cached@mail.com')
+            user.set_password('abcabcabc')
+            user.save()
+            token = Token.objects.get(user=user)
+            self.client.credentials(
+                HTTP_AUTHORIZATION='Token ' + token.key
+            )
+
+            with self.assertNumQueries(1):
+                self.assertEqual(auth.token_user(token.key), user)
+            with self.assertNumQueries(0):
+                cached = auth.token_user(token.key)
+            self.assertEqual(cached, user)
+            self.assertEqual(cached.email, user.email)
+            # The password hash stays in the database
+            entry = caches['tokens'].get(auth.token_cache_key(token.key))
+            self.assertNotIn('password', entry[1])
+            self.assertNotIn(user.password, repr(entry))
+
+            with self.assertNumQueries(0):
+                self.assertEqual(
+                    auth.CachedTokenAuthentication().authenticate_credentials(
+                        token.key
+                    ),
+                    (user, token),
+                )
+
+            response = self.client.get(reverse('mobile_my_orders'))
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+            user.is_active = False
+            user.save()
+            self.assertIsNone(auth.token_user(token.key))
+            response = self.client.get(reverse('mobile_my_orders'))
+            # Session authentication comes first, hence 403 rather than 401
+            self.assertEqual(
+                response.status_code, status.HTTP_403_FORBIDDEN
+            )
+
+            user.is_active = True
+            user.save()
+            self.assertEqual(auth.token_user(token.key), user)
+            models.User.objects.filter(pk=user.pk).update(is_active=False)
+            self.assertIsNone(auth.token_user(token.key))
+
+            models.User.objects.filter(pk=user.pk).update(is_active=True)
+            self.assertEqual(auth.token_user(token.key), user)
+            token.delete()
+            self.assertIsNone(auth.token_user(token.key))
+
+    def test_token_users_are_not_cached_in_process_memory(self):
+        user = factories.UserFactory(email='uncached@mail.com')
+        token = Token.objects.get(user=user)
+        with override_settings(
+            CACHES={
+                'default': {
+                    'BACKEND': (
+                        'django.core.cache.backends.locmem.LocMemCache'
+                    ),
+                },
+            },
+            TOKEN_CACHE='default',
+        ):
+            self.assertIsNone(auth.token_cache())
+            for _ in range(2):
+                with self.assertNumQueries(1):
+                    self.assertEqual(auth.token_user(token.key), user)
@@ -1,3 +1,4 @@
+import json
 from io import StringIO
 import tempfile
 from django.conf import settings
@@ -23,4 +24,28 @@ class TestImport(TestCase):
         self.assertEqual(out.getvalue(), expected_out)
         self.assertEqual(models.Product.objects.count(), 3)
         self.assertEqual(models.ProductTag.objects.count(), 6)
-        self.assertEqual(models.ProductImage.objects.count(), 3)
\ No newline at end of file
+        self.assertEqual(models.ProductImage.objects.count(), 3)
+
+
+class TestImportBenchmark(TestCase):
+    def test_benchmark_reports_and_rolls_back(self):
+        out = StringIO()
+        call_command(
+            'benchmark_import',
+            '--sizes', '3', '5',
+            '--images', '2',
+            '--trace-memory',
+            stdout=out,
+            stderr=StringIO(),
+        )
+
+        report = json.loads(out.getvalue())
+        self.assertEqual(
+            [r['rows'] for r in report['results']], [3, 5]
+        )
+        for result in report['results']:
+            self.assertGreater(result['queries_per_row'], 0)
+            self.assertGreater(result['rows_per_second'], 0)
+            self.assertGreater(result['peak_traced_kb'], 0)
+        self.assertEqual(models.Product.objects.count(), 0)
+        self.assertEqual(models.ProductImage.objects.count(), 0)
@@ -1,5 +1,8 @@
+import threading
 from decimal import Decimal
-from django.test import TestCase
+from unittest import skipUnless
+from django.db import DatabaseError, connection, transaction
+from django.test import TestCase, TransactionTestCase
 from main import models
 from main import factories
 
@@ -44,3 +47,136 @@ class TestModel(TestCase):
         lines = order.lines.all()
         self.assertEqual(lines[0].product, p1)
         self.assertEqual(lines[1].product, p2)
+
+    def test_daily_sales_follow_order_lines(self):
+        a = factories.ProductFactory(price=Decimal('10.00'))
+        b = factories.ProductFactory(price=Decimal('4.00'))
+        orders = factories.OrderFactory.create_batch(
+            2, shipping_country='pl'
+        )
+        factories.OrderLineFactory.create_batch(
+            2, order=orders[0], product=a
+        )
+        factories.OrderLineFactory(order=orders[1], product=a)
+        cancelled = factories.OrderLineFactory(
+            order=orders[1], product=b
+        )
+        cancelled.status = models.OrderLine.CANCELLED
+        cancelled.save()
+        # Refreshes wait for a commit, which TestCase never does
+        self.assertFalse(models.DailySales.objects.exists())
+        models.DailySales.objects.refresh_scheduled()
+
+        rows = {
+            r.product_id: (r.orders, r.units, r.revenue)
+            for r in models.DailySales.objects.filter(country='pl')
+        }
+        self.assertEqual(
+            rows,
+            {
+                a.id: (2, 3, Decimal('30.00')),
+                None: (2, 3, Decimal('30.00')),
+            },
+        )
+
+        models.DailySales.objects.all().delete()
+        models.DailySales.objects.rebuild()
+        rebuilt = {
+            r.product_id: (r.orders, r.units, r.revenue)
+            for r in models.DailySales.objects.filter(country='pl')
+        }
+        self.assertEqual(rebuilt, rows)
+
+        # Refreshing again updates the rows in place
+        models.DailySales.objects.refresh(*orders[0].sales_bucket)
+        self.assertEqual(
+            models.DailySales.objects.filter(country='pl').count(), 2
+        )
+
+    def test_order_saves_refresh_daily_sales_only_on_bucket_change(self):
+        order = factories.OrderFactory(shipping_country='pl')
+        models.DailySales.objects.refresh_scheduled()
+        order = models.Order.objects.get(pk=order.pk)
+
+        order.status = models.Order.DONE
+        order.save()
+        self.assertFalse(models.DailySales.objects.scheduled().buckets)
+
+        order.shipping_country = 'de'
+        order.save()
+        self.assertEqual(
+            set(models.DailySales.objects.scheduled().buckets),
+            {
+                (order.sales_bucket[0], 'pl'),
+                (order.sales_bucket[0], 'de'),
+            },
+        )
+        models.DailySales.objects.refresh_scheduled()
+        self.assertEqual(
+            list(
+                models.DailySales.objects.values_list('country', 'orders')
+            ),
+            [('de', 1)],
+        )
+
+    def test_daily_sales_are_scheduled_once_per_transaction(self):
+        models.DailySales.objects.refresh_scheduled()
+        product = factories.ProductFactory()
+        order = factories.OrderFactory(shipping_country='pl')
+        factories.OrderLineFactory.create_batch(
+            3, order=order, product=product
+        )
+        callbacks = [
+            callback
+            for _, callback in connection.run_on_commit
+            if isinstance(callback, models.SalesBuckets)
+        ]
+        self.assertEqual(len(callbacks), 1)
+
+        try:
+            with transaction.atomic():
+                factories.OrderFactory(shipping_country='de')
+                raise DatabaseError
+        except DatabaseError:
+            pass
+        # Rolled back with the savepoint that scheduled it
+        self.assertEqual(
+            set(models.DailySales.objects.scheduled().buckets),
+            {(order.sales_bucket[0], 'pl')},
+        )
+
+
+@skipUnless(connection.vendor == 'postgresql', 'Needs PostgreSQL')
+class TestDailySalesConcurrency(TransactionTestCase):
+    def test_concurrent_refreshes_keep_one_row_per_bucket(self):
+        order = factories.OrderFactory(shipping_country='pl')
+        factories.OrderLineFactory(
+            order=order, product=factories.ProductFactory()
+        )
+        models.DailySales.objects.all().delete()
+        barrier = threading.Barrier(4)
+        errors = []
+
+        def refresh():
+            try:
+                barrier.wait()
+                models.DailySales.objects.refresh(*order.sales_bucket)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=refresh) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(
+            models.DailySales.objects.filter(
+                product__isnull=True
+            ).count(),
+            1,
+        )
+        self.assertEqual(models.DailySales.objects.count(), 2)
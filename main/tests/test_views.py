@@ -1,3 +1,4 @@
+import json
 from decimal import Decimal
 from unittest.mock import patch
 
@@ -5,7 +6,7 @@ from django.contrib import auth
 from django.test import TestCase
 from django.urls import reverse
 
-from main import forms, models
+from main import factories, forms, models
 
 
 # Create your tests here.
@@ -312,4 +313,84 @@ class TestPage(TestCase):
             models.Basket.objects.filter(user=user1).exists()
         )
         basket = models.Basket.objects.get(user=user1)
-        self.assertEqual(basket.count(), 3)
\ No newline at end of file
+        self.assertEqual(basket.count(), 3)
+
+    def test_order_export_streams_filtered_orders(self):
+        staff = models.User.objects.create_user(
+            'staff@a.com', 'topsecret', is_staff=True
+        )
+        customer = models.User.objects.create_user(
+            'customer@a.com', 'topsecret'
+        )
+        other = models.User.objects.create_user(
+            'other@a.com', 'topsecret'
+        )
+        product = models.Product.objects.create(
+            name='Joker', slug='joker', price=Decimal('10.00')
+        )
+        order = factories.OrderFactory(user=customer)
+        factories.OrderFactory(user=other)
+        factories.OrderLineFactory.create_batch(
+            2, order=order, product=product
+        )
+        self.client.force_login(staff)
+
+        response = self.client.get(
+            reverse('order_export'),
+            {'user__email__icontains': 'customer', 'format': 'csv'},
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        rows = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(rows[0].split(',')[:2], ['id', 'user__email'])
+        self.assertEqual(len(rows), 2)
+        self.assertIn('customer@a.com', rows[1])
+
+        response = self.client.get(
+            reverse('orderline_export'),
+            {'user__email__icontains': 'customer', 'format': 'ndjson'},
+        )
+        lines = [
+            json.loads(line)
+            for line in b''.join(response.streaming_content).splitlines()
+        ]
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(lines[0]['product__name'], 'Joker')
+        self.assertEqual(lines[0]['order_id'], order.id)
+
+    def test_order_dashboard_uses_keyset_pages(self):
+        staff = models.User.objects.create_user(
+            'staff@a.com', 'topsecret', is_staff=True
+        )
+        orders = factories.OrderFactory.create_batch(3, user=staff)
+        self.client.force_login(staff)
+
+        with patch('main.views.OrderView.page_size', 2):
+            response = self.client.get(reverse('order_dashboard'))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(
+                [o.id for o in response.context['table'].data],
+                [orders[2].id, orders[1].id],
+            )
+            next_query = response.context['next_query']
+            self.assertIsNotNone(next_query)
+
+            response = self.client.get(
+                reverse('order_dashboard') + '?' + next_query
+            )
+            self.assertEqual(
+                [o.id for o in response.context['table'].data],
+                [orders[0].id],
+            )
+            self.assertIsNone(response.context['next_query'])
+
+            # A malformed cursor shows the first page
+            for after in ('garbage', 'garbage,1', '2020-01-01T00:00,x'):
+                response = self.client.get(
+                    reverse('order_dashboard'), {'after': after}
+                )
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(
+                    [o.id for o in response.context['table'].data],
+                    [orders[2].id, orders[1].id],
+                )
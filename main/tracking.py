@@ -0,0 +1,237 @@
+"""
+Order tracking lookups against the carrier.
+
+A process-wide aiohttp session pools the connections to the carrier,
+payloads are cached per order for ORDER_TRACKER_CACHE_TTL seconds and
+concurrent lookups of the same order share a single upstream request.
+
+Upstream calls go through a circuit breaker. Once a payload is stale,
+it is still served when the circuit is open or the carrier does not
+answer within ORDER_TRACKER_STALE_TIMEOUT seconds, while the refresh
+goes on in the background.
+"""
+import asyncio
+import logging
+import time
+
+import aiohttp
+from django.conf import settings
+
+from . import exceptions
+from .metrics import registry
+
+logger = logging.getLogger(__name__)
+
+CACHE_SIZE = 10000
+
+UPSTREAM_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError)
+
+circuit_open = registry.gauge(
+    'tracker_circuit_open', '1 while the carrier circuit is open'
+)
+circuit_opened = registry.counter(
+    'tracker_circuit_opened', 'Times the carrier circuit opened'
+)
+upstream_failures = registry.counter(
+    'tracker_upstream_failures', 'Failed carrier requests'
+)
+upstream_seconds = registry.summary(
+    'tracker_upstream_seconds', 'Duration of successful carrier requests'
+)
+rejected = registry.counter(
+    'tracker_rejected', 'Lookups refused while the circuit was open'
+)
+stale_responses = registry.counter(
+    'tracker_stale_responses', 'Lookups answered with a stale payload'
+)
+
+
+class CircuitBreaker:
+    """
+    Opens after ORDER_TRACKER_FAILURE_THRESHOLD consecutive failures.
+
+    Once ORDER_TRACKER_RESET_TIMEOUT seconds have passed, a single trial
+    request is let through (half-open): its success closes the circuit
+    again, its failure opens it for another period.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return self.CLOSED
+        if self.trial or time.monotonic() - self.opened_at >= getattr(
+            settings, 'ORDER_TRACKER_RESET_TIMEOUT', 30
+        ):
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def allow(self):
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        if state == self.HALF_OPEN and not self.trial:
+            self.trial = True
+            return True
+        rejected.inc()
+        return False
+
+    def success(self):
+        if self.opened_at is not None:
+            logger.info('Carrier circuit closed')
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        circuit_open.set(0)
+
+    def failure(self):
+        self.failures += 1
+        upstream_failures.inc()
+        threshold = getattr(settings, 'ORDER_TRACKER_FAILURE_THRESHOLD', 5)
+        if self.trial or (
+            self.opened_at is None and self.failures >= threshold
+        ):
+            logger.warning(
+                'Carrier circuit opened after %d failures', self.failures
+            )
+            self.opened_at = time.monotonic()
+            self.trial = False
+            circuit_opened.inc()
+            circuit_open.set(1)
+
+
+class TrackingClient:
+    def __init__(self):
+        self.session = None
+        self.loop = None
+        # order id -> (payload, fetch time on the monotonic clock)
+        self.cache = {}
+        self.in_flight = {}
+        self.breaker = CircuitBreaker()
+
+    def get_session(self):
+        loop = asyncio.get_event_loop()
+        if self.loop is not loop:
+            # Sessions and futures belong to the loop they were created in
+            self.loop = loop
+            self.session = None
+            self.in_flight = {}
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(
+                    total=getattr(settings, 'ORDER_TRACKER_TIMEOUT', 5)
+                ),
+                connector=aiohttp.TCPConnector(
+                    limit=getattr(settings, 'ORDER_TRACKER_CONNECTIONS', 20)
+                ),
+            )
+        return self.session
+
+    def url(self, order_id):
+        return settings.ORDER_TRACKER_URL.format(order_id=order_id)
+
+    async def fetch(self, order_id):
+        """ Requests the tracking payload of an order from the carrier """
+        started = time.monotonic()
+        try:
+            async with self.get_session().get(self.url(order_id)) as resp:
+                resp.raise_for_status()
+                payload = await resp.read()
+        except asyncio.CancelledError:
+            # Let another trial through if this one was the trial
+            self.breaker.trial = False
+            raise
+        except Exception:
+            # Any error fails the trial, or the circuit would stay
+            # half-open with no trial let through
+            self.breaker.failure()
+            raise
+
+        now = time.monotonic()
+        self.breaker.success()
+        upstream_seconds.observe(now - started)
+        if len(self.cache) >= CACHE_SIZE:
+            newest = sorted(
+                self.cache.items(), key=lambda item: item[1][1]
+            )[CACHE_SIZE // 2:]
+            self.cache = dict(newest)
+        self.cache[order_id] = (payload, now)
+        return payload
+
+    def refresh(self, order_id):
+        """ Returns the pending upstream request of an order, or starts one """
+        self.get_session()
+        future = self.in_flight.get(order_id)
+        if future is None:
+            logger.info('Fetching tracking of order %s', order_id)
+            future = asyncio.ensure_future(self.fetch(order_id))
+            self.in_flight[order_id] = future
+            future.add_done_callback(
+                lambda f: self.done(order_id, f)
+            )
+        return future
+
+    def done(self, order_id, future):
+        self.in_flight.pop(order_id, None)
+        if not future.cancelled() and future.exception() is not None:
+            # Retrieved here so background refreshes do not log warnings
+            logger.info(
+                'Tracking of order %s failed: %r',
+                order_id,
+                future.exception(),
+            )
+
+    async def get(self, order_id):
+        """
+        Returns the tracking payload of an order and, when it is stale,
+        its age in seconds (None otherwise).
+
+        Raises TrackingUnavailable when the circuit is open and nothing
+        is cached; carrier errors are raised when nothing is cached.
+        """
+        entry = self.cache.get(order_id)
+        if entry is not None:
+            payload, fetched = entry
+            age = time.monotonic() - fetched
+            if age < getattr(settings, 'ORDER_TRACKER_CACHE_TTL', 60):
+                return payload, None
+
+            if order_id in self.in_flight or self.breaker.allow():
+                future = self.refresh(order_id)
+                try:
+                    # A cancelled caller must not cancel the refresh
+                    return (
+                        await asyncio.wait_for(
+                            asyncio.shield(future),
+                            getattr(
+                                settings, 'ORDER_TRACKER_STALE_TIMEOUT', 1
+                            ),
+                        ),
+                        None,
+                    )
+                except UPSTREAM_ERRORS:
+                    pass
+            stale_responses.inc()
+            return payload, age
+
+        if order_id not in self.in_flight and not self.breaker.allow():
+            raise exceptions.TrackingUnavailable(
+                'The carrier circuit is open'
+            )
+        return await asyncio.shield(self.refresh(order_id)), None
+
+    async def close(self):
+        """ Closes the session, e.g. on shutdown """
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+
+client = TrackingClient()
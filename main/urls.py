@@ -75,6 +75,21 @@ urlpatterns = [
         views.OrderView.as_view(),
         name='order_dashboard',
     ),
+    path(
+        'order-dashboard/export/orders/',
+        views.OrderExportView.as_view(),
+        name='order_export',
+    ),
+    path(
+        'order-dashboard/export/lines/',
+        views.OrderLineExportView.as_view(),
+        name='orderline_export',
+    ),
+    path(
+        'api/dispatch/',
+        endpoints.dispatch_orders,
+        name='dispatch_orders',
+    ),
     path('api/', include(router.urls)),
     path(
         'customer-service/<int:order_id>/',
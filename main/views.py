@@ -2,7 +2,7 @@ from django.shortcuts import render
 from django.views.generic.edit import FormView
 from django.views.generic.list import ListView
 from django.shortcuts import get_object_or_404
-from main import forms, models
+from main import exports, forms, models, paginators
 from django.contrib.auth import login, authenticate
 from django.contrib import messages
 import logging
@@ -14,6 +14,7 @@ from django.views.generic.edit import (
     DeleteView
 )
 from django.http import HttpResponseRedirect
+from django.views import View
 from django.urls import reverse
 from django.contrib.auth.mixins import (
     LoginRequiredMixin,
@@ -22,6 +23,7 @@ from django.contrib.auth.mixins import (
 from django import forms as django_forms
 from django.db import models as django_models
 import django_filters
+import django_tables2
 from django_filters.views import FilterView
 
 
@@ -215,6 +217,8 @@ class OrderFilter(django_filters.FilterSet):
     class Meta:
         model = models.Order
 
+        # user__email__icontains is served by the trigram index
+        # created in migration 0008 on PostgreSQL
         fields = {
             'user__email': ['icontains'],
             'status': ['exact'],
@@ -232,13 +236,142 @@ class OrderFilter(django_filters.FilterSet):
         }
 
 
+class OrderTable(django_tables2.Table):
+    user = django_tables2.Column(accessor='user__email')
+
+    class Meta:
+        model = models.Order
+        fields = (
+            'id',
+            'user',
+            'status',
+            'shipping_name',
+            'shipping_city',
+            'shipping_country',
+            'date_added',
+            'date_updated',
+        )
+        orderable = False
+
+
 class OrderView(UserPassesTestMixin, FilterView):
+    """
+    Order dashboard paginated with a keyset on (-date_added, -id).
+
+    The cursor of the next page is passed as ?after=<date_added>,<id>,
+    so deep pages cost the same as the first one.
+    """
     filterset_class = OrderFilter
     login_url = reverse_lazy('login')
+    page_size = 50
+    columns = (
+        'id',
+        'status',
+        'shipping_name',
+        'shipping_city',
+        'shipping_country',
+        'date_added',
+        'date_updated',
+        'user__email',
+    )
 
     def test_func(self):
         return self.request.user.is_staff is True
 
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        orders = (
+            self.object_list.select_related('user')
+            .only(*self.columns)
+            .order_by('-date_added', '-id')
+        )
+
+        cursor = paginators.parse_cursor(self.request.GET)
+        if cursor:
+            date_added, pk = cursor
+            orders = orders.filter(
+                django_models.Q(date_added__lt=date_added)
+                | django_models.Q(date_added=date_added, id__lt=pk)
+            )
+
+        page = list(orders[:self.page_size + 1])
+        next_query = None
+        if len(page) > self.page_size:
+            page = page[:self.page_size]
+            next_query = paginators.next_page_query(
+                self.request.GET, page[-1].date_added, page[-1].id
+            )
+
+        first_params = self.request.GET.copy()
+        first_params.pop('after', None)
+        context.update(
+            table=OrderTable(page),
+            next_query=next_query,
+            first_query=first_params.urlencode() if cursor else None,
+        )
+        return context
+
+
+class OrderExportView(UserPassesTestMixin, View):
+    """ Streams the orders matching OrderFilter as CSV or NDJSON """
+    login_url = reverse_lazy('login')
+    fields = (
+        'id',
+        'user__email',
+        'status',
+        'billing_name',
+        'billing_address1',
+        'billing_address2',
+        'billing_zip_code',
+        'billing_city',
+        'billing_country',
+        'shipping_name',
+        'shipping_address1',
+        'shipping_address2',
+        'shipping_zip_code',
+        'shipping_city',
+        'shipping_country',
+        'date_added',
+        'date_updated',
+    )
+    filename = 'orders'
+
+    def test_func(self):
+        return self.request.user.is_staff is True
+
+    def get_queryset(self, orders):
+        return orders.order_by('id')
+
+    def get(self, request):
+        orders = OrderFilter(
+            request.GET, queryset=models.Order.objects.all()
+        ).qs
+        return exports.export_response(
+            exports.queryset_rows(
+                self.get_queryset(orders), self.fields
+            ),
+            self.fields,
+            self.filename,
+            request.GET.get('format', 'csv'),
+        )
+
+
+class OrderLineExportView(OrderExportView):
+    """ Streams the lines of the orders matching OrderFilter """
+    fields = (
+        'id',
+        'order_id',
+        'product__name',
+        'product__price',
+        'status',
+    )
+    filename = 'orderlines'
+
+    def get_queryset(self, orders):
+        return models.OrderLine.objects.filter(
+            order__in=orders
+        ).order_by('order_id', 'id')
+
 
 def room(request, order_id):
     return render(